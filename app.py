@@ -1,12 +1,26 @@
 import os
 import sys
 import io
-import zipfile
-from collections import defaultdict
+import json
+import time
+import threading
+from collections import defaultdict, deque
+from itertools import groupby
+import tempfile
+from concurrent.futures import BrokenExecutor, ThreadPoolExecutor
 from datetime import datetime
-from flask import Flask, request, send_file, render_template_string, jsonify
-from reportlab.lib.pagesizes import LETTER
-from reportlab.pdfgen import canvas
+from flask import Flask, Response, request, send_file, render_template_string, jsonify, url_for, make_response
+import data_index
+import record_reader
+import columnar_store
+import patient_catalog
+import bill_cache
+import bill_layout
+import bill_render
+import bill_zip
+import metrics
+import jobs
+import warmup
 
 app = Flask(__name__)
 
@@ -22,6 +36,61 @@ def get_file_path():
     return os.path.join(os.path.dirname(os.path.abspath(__file__)), 'Financials.txt')
 
 FILE_PATH = get_file_path()
+INDEX_PATH = data_index.default_index_path(FILE_PATH)
+STORE_PATH = columnar_store.default_store_path(FILE_PATH)
+CATALOG_PATH = patient_catalog.default_catalog_path(FILE_PATH)
+
+# Finished bill ZIPs, keyed by patient ID and data file version
+BILL_CACHE = bill_cache.BillCache(
+    max_bytes=int(os.environ.get('BILL_CACHE_MB', 64)) * 1024 * 1024,
+    disk_dir=os.environ.get('BILL_CACHE_DIR') or None,
+    disk_max_bytes=int(os.environ.get('BILL_CACHE_DISK_MB', 1024)) * 1024 * 1024,
+    suffix=bill_zip.CACHE_SUFFIX,
+)
+
+# Rendered per-date PDFs, keyed by the content of that date's rows
+PDF_CACHE = bill_cache.BillCache(
+    max_bytes=int(os.environ.get('PDF_CACHE_MB', 128)) * 1024 * 1024,
+    disk_dir=os.path.join(os.environ['BILL_CACHE_DIR'], 'pdf') if os.environ.get('BILL_CACHE_DIR') else None,
+    disk_max_bytes=int(os.environ.get('BILL_CACHE_DISK_MB', 1024)) * 1024 * 1024,
+    suffix='.pdf',
+)
+
+# Process pool for rendering patients with many service dates
+RENDER_WORKERS = int(os.environ.get('RENDER_WORKERS') or os.cpu_count() or 1)
+RENDER_POOL_MIN_DATES = int(os.environ.get('RENDER_POOL_MIN_DATES', 8))
+_render_pool = None
+_render_pool_lock = threading.Lock()
+
+# Stream ZIPs entry by entry instead of buffering them (override per request with ?stream=0/1)
+STREAM_ZIPS = os.environ.get('STREAM_ZIPS', '0') == '1'
+
+# Largest number of patient IDs accepted by one /batch-pdf request. The whole batch
+# renders inside one request, so it must finish within the worker timeout (120s on
+# Render); larger runs belong to `cli.py batch` or `cli.py export`
+BATCH_MAX_PATIENTS = int(os.environ.get('BATCH_MAX_PATIENTS', 500))
+
+# Background bill generation jobs (local SQLite + result files)
+JOBS_DIR = os.environ.get('JOBS_DIR') or os.path.join(tempfile.gettempdir(), 'patient_bill_jobs')
+JOB_WORKERS = int(os.environ.get('JOB_WORKERS', 2))
+JOB_TTL_HOURS = float(os.environ.get('JOB_TTL_HOURS', 24))
+
+# Most patients one /search returns
+SEARCH_MAX_RESULTS = int(os.environ.get('SEARCH_MAX_RESULTS', 500))
+
+# Warm caches before /health reports healthy: load the index, touch font
+# metrics and pre-render bills for WARMUP_PATIENTS plus the WARMUP_RECENT
+# most recently seen patients, giving up on bills after WARMUP_MAX_SECONDS
+WARMUP = os.environ.get('WARMUP', '0') == '1'
+WARMUP_PATIENTS = [value.strip() for value in os.environ.get('WARMUP_PATIENTS', '').split(',') if value.strip()]
+WARMUP_RECENT = int(os.environ.get('WARMUP_RECENT', 0))
+WARMUP_MAX_SECONDS = float(os.environ.get('WARMUP_MAX_SECONDS', 300))
+
+# Add a Server-Timing header with per-stage durations to /patient-pdf responses
+SERVER_TIMING = os.environ.get('SERVER_TIMING', '0') == '1'
+_job_store = None
+_job_executor = None
+_job_lock = threading.Lock()
 
 # HTML template embedded in Python for Render deployment
 HTML_TEMPLATE = """
@@ -157,6 +226,7 @@ HTML_TEMPLATE = """
       height: 100%;
       background: rgba(255, 255, 255, 0.8);
       z-index: 999;
+      flex-direction: column;
       justify-content: center;
       align-items: center;
     }
@@ -170,6 +240,12 @@ HTML_TEMPLATE = """
       animation: spin 1s linear infinite;
     }
 
+    .progress-text {
+      margin-top: 20px;
+      font-size: 16px;
+      color: #333;
+    }
+
     @keyframes spin {
       0%   { transform: rotate(0deg); }
       100% { transform: rotate(360deg); }
@@ -200,6 +276,7 @@ HTML_TEMPLATE = """
 <body>
   <div class="spinner-overlay" id="loadingSpinner">
     <div class="spinner"></div>
+    <div class="progress-text" id="progressText"></div>
   </div>
 
   <div class="container">
@@ -230,6 +307,7 @@ HTML_TEMPLATE = """
     const statusDiv = document.getElementById('statusDiv');
     const submitBtn = document.getElementById('submitBtn');
     const healthStatus = document.getElementById('healthStatus');
+    const progressText = document.getElementById('progressText');
 
     // Check health status on load
     window.addEventListener('load', function() {
@@ -270,22 +348,41 @@ HTML_TEMPLATE = """
       }
 
       try {
-        const response = await fetch(`/patient-pdf?patient_id=${encodeURIComponent(patientId)}`);
+        // Queue a background job, then poll it instead of holding one long request open
+        const response = await fetch('/jobs', {
+          method: 'POST',
+          headers: { 'Content-Type': 'application/json' },
+          body: JSON.stringify({ patient_id: patientId })
+        });
 
         if (!response.ok) {
           const errorText = await response.text();
           throw new Error(errorText || `Server responded with status ${response.status}`);
         }
 
-        const blob = await response.blob();
-        const url = window.URL.createObjectURL(blob);
+        let job = await response.json();
+        while (job.status === 'queued' || job.status === 'running') {
+          progressText.textContent = job.total
+            ? `Rendering bills: ${job.done} / ${job.total}`
+            : 'Waiting to start...';
+          await new Promise(resolve => setTimeout(resolve, 1000));
+          const statusResponse = await fetch(job.status_url);
+          if (!statusResponse.ok) {
+            throw new Error(`Server responded with status ${statusResponse.status}`);
+          }
+          job = await statusResponse.json();
+        }
+
+        if (job.status !== 'done') {
+          throw new Error(job.error || 'Bill generation failed');
+        }
+
         const link = document.createElement('a');
-        link.href = url;
+        link.href = job.download_url;
         link.download = `${patientId}_bills.zip`;
         document.body.appendChild(link);
         link.click();
         link.remove();
-        window.URL.revokeObjectURL(url);
         
         showStatus("Bills generated and downloaded successfully!", "success");
       } catch (error) {
@@ -293,6 +390,7 @@ HTML_TEMPLATE = """
         showStatus("Error: " + error.message, "error");
       } finally {
         spinner.style.display = 'none';
+        progressText.textContent = '';
         submitBtn.disabled = false;
         submitBtn.textContent = 'Generate & Download Bills';
       }
@@ -302,6 +400,7 @@ HTML_TEMPLATE = """
 </html>
 """
 
+@metrics.timed('search_rows')
 def search_rows(patient_id):
     """Search for patient rows in the data file"""
     rows = []
@@ -309,20 +408,79 @@ def search_rows(patient_id):
         if not os.path.exists(FILE_PATH):
             print(f"Warning: Data file not found at {FILE_PATH}")
             return rows
-            
-        with open(FILE_PATH, 'r', encoding='utf-8') as f:
-            headers = f.readline().strip().split('|')
-            for line in f:
-                cols = line.strip().split('|')
-                if len(cols) != len(headers):
-                    continue
-                row = dict(zip(headers, cols))
-                if row.get('patient_id', '').lower() == patient_id.lower():
-                    rows.append(row)
+
+        # Prefer the columnar store when one has been built with `cli.py build-store`
+        store = columnar_store.get_store(FILE_PATH, STORE_PATH)
+        if store is not None:
+            rows = store.read_rows(patient_id)
+        else:
+            reader = record_reader.get_reader(FILE_PATH)
+            index = data_index.get_index(FILE_PATH, INDEX_PATH, wait=False)
+            if index is None:
+                # A new index generation is being built (or cannot be written); scan instead
+                rows = reader.scan(patient_id)
+            else:
+                rows = reader.read_records(index.locate(patient_id))
     except Exception as e:
         print(f"Error reading file: {e}")
+    metrics.inc('rows_matched', len(rows))
     return rows
 
+@metrics.timed('search_many_rows')
+def search_many_rows(patient_ids):
+    """Search rows for many patients at once, keyed by the requested IDs
+
+    Index lookups are read back in file order, and without an index the data
+    file is scanned a single time for all of the IDs together.
+    """
+    keys = {patient_id.lower() for patient_id in patient_ids}
+    found = {key: [] for key in keys}
+    try:
+        if not os.path.exists(FILE_PATH):
+            print(f"Warning: Data file not found at {FILE_PATH}")
+            return {patient_id: [] for patient_id in patient_ids}
+
+        store = columnar_store.get_store(FILE_PATH, STORE_PATH)
+        reader = record_reader.get_reader(FILE_PATH)
+        if store is not None:
+            found = {key: store.read_rows(key) for key in keys}
+        else:
+            index = data_index.get_index(FILE_PATH, INDEX_PATH, wait=False)
+            if index is None:
+                found = reader.scan_many(keys)
+            else:
+                locations = sorted((offset, length, key) for key in keys
+                                   for offset, length in index.locate(key))
+                for offset, length, key in locations:
+                    found[key].append(reader.row_type(reader.record_columns(offset, length)))
+                metrics.inc('rows_scanned', len(locations))
+    except Exception as e:
+        print(f"Error reading file: {e}")
+    metrics.inc('rows_matched', sum(len(rows) for rows in found.values()))
+    return {patient_id: found.get(patient_id.lower(), []) for patient_id in patient_ids}
+
+def configure_data_paths(data_path, index_path=None, store_path=None, catalog_path=None):
+    """Point the app at a different data file (and its index/store/catalog), e.g. from the CLI"""
+    global FILE_PATH, INDEX_PATH, STORE_PATH, CATALOG_PATH
+    FILE_PATH = data_path
+    INDEX_PATH = index_path or data_index.default_index_path(data_path)
+    STORE_PATH = store_path or columnar_store.default_store_path(data_path)
+    CATALOG_PATH = catalog_path or patient_catalog.default_catalog_path(data_path)
+
+def load_patient_index():
+    """Attach to the patient index and catalog, building them in the background if needed
+
+    Called from the server startup hooks (gunicorn, the ASGI lifespan, __main__)
+    rather than at import, so importing the app for the CLI or tests never
+    starts a build, and only after the data paths are configured.
+    """
+    try:
+        if os.path.exists(FILE_PATH):
+            data_index.get_index(FILE_PATH, INDEX_PATH, wait=False)
+            patient_catalog.get_catalog(FILE_PATH, CATALOG_PATH, wait=False)
+    except Exception as e:
+        print(f"Warning: Could not load patient index: {e}")
+
 def get_raw_diagnosis_data(diagnosis_string):
     """Extract raw diagnosis data"""
     return diagnosis_string.strip() if diagnosis_string else ""
@@ -331,17 +489,14 @@ def extract_patient_data(rows):
     """Extract patient and provider information"""
     rendering_providers = set()
     for row in rows:
-        first_name = row.get('rendering_first_name', '').strip()
-        last_name = row.get('rendering_last_name', '').strip()
-        if first_name and last_name:
-            rendering_providers.add(f"Dr. {first_name} {last_name}")
-        elif first_name:
-            rendering_providers.add(f"Dr. {first_name}")
-        elif last_name:
-            rendering_providers.add(f"Dr. {last_name}")
+        provider = patient_catalog.provider_name(row.get('rendering_first_name', ''),
+                                                 row.get('rendering_last_name', ''))
+        if provider:
+            rendering_providers.add(provider)
     provider = ', '.join(sorted(rendering_providers)) if rendering_providers else 'N/A'
-    return provider, "9741 Preston Road Frisco, TX 75033-2793, (972) 335-2004"
+    return provider, bill_layout.CLINIC_LOCATION
 
+@metrics.timed('extract_service_date_icd_codes')
 def extract_service_date_icd_codes(rows):
     """Extract ICD codes by service date"""
     service_date_diagnosis = defaultdict(set)
@@ -352,226 +507,252 @@ def extract_service_date_icd_codes(rows):
             raw_diagnosis = get_raw_diagnosis_data(diagnosis_dxs)
             if raw_diagnosis:
                 service_date_diagnosis[service_date].add(raw_diagnosis)
-    return {date: list(codes) for date, codes in service_date_diagnosis.items()}
-
-def generate_pdf(rows, provider, location, service_date_icds):
-    """Generate PDF bill for patient - Optimized for speed"""
-    buffer = io.BytesIO()
-    c = canvas.Canvas(buffer, pagesize=LETTER)
-    width, height = LETTER
-
-    MARGIN_LEFT = 50
-    MARGIN_RIGHT = 50
-    y = height - 60
-
-    # Pre-calculate font metrics for speed
-    font_metrics = {
-        'title': ('Helvetica-Bold', 16),
-        'section': ('Helvetica-Bold', 12),
-        'normal': ('Helvetica', 11),
-        'small': ('Helvetica', 9),
-        'table_header': ('Helvetica-Bold', 11)
-    }
-
-    def set_font(font_type):
-        font_name, font_size = font_metrics[font_type]
-        c.setFont(font_name, font_size)
-
-    def draw_title():
-        nonlocal y
-        set_font('title')
-        c.drawCentredString(width / 2, y, "PATIENT BILLING STATEMENT")
-        y -= 40
-
-    def draw_patient_info():
-        nonlocal y
-        patient = rows[0]  # Use first row for patient info
-        name = patient.get('patient_name', 'N/A')
-        pid = patient.get('patient_id', 'N/A')
-        
-        # Pre-build address string
-        address_parts = [
-            patient.get('patient_address1', '').strip(),
-            patient.get('patient_city', '').strip(),
-            patient.get('patient_state', '').strip(),
-            patient.get('patient_zip', '').strip()
-        ]
-        address = ", ".join(filter(None, address_parts))
-        
-        set_font('section')
-        c.drawString(MARGIN_LEFT, y, "PATIENT INFORMATION")
-        y -= 20
-        set_font('normal')
-        c.drawString(MARGIN_LEFT, y, f"Name: {name}    Patient ID: #{pid}")
-        y -= 18
-        c.drawString(MARGIN_LEFT, y, f"Address: {address}")
-        y -= 30
-
-    def draw_provider_info():
-        nonlocal y
-        set_font('section')
-        c.drawString(MARGIN_LEFT, y, "PROVIDER INFORMATION")
-        y -= 20
-        set_font('normal')
-        c.drawString(MARGIN_LEFT, y, f"Provider: {provider}")
-        y -= 18
-        c.drawString(MARGIN_LEFT, y, f"Location: {location}")
-        y -= 30
-
-    def draw_services_table():
-        nonlocal y
-        set_font('section')
-        c.drawString(MARGIN_LEFT, y, "SERVICES & CHARGES")
-        y -= 25
-
-        headers = ["Sr.", "Date", "Code", "Description", "Modifier", "Units", "Charge"]
-        col_positions = [MARGIN_LEFT, MARGIN_LEFT + 25, MARGIN_LEFT + 85, 
-                        MARGIN_LEFT + 130, MARGIN_LEFT + 400, MARGIN_LEFT + 450, MARGIN_LEFT + 490]
-
-        set_font('table_header')
-        for i, header in enumerate(headers):
-            c.drawString(col_positions[i], y, header)
-        
-        y -= 15
-        c.setLineWidth(0.5)
-        c.line(MARGIN_LEFT, y, width - MARGIN_RIGHT, y)
-        y -= 10
-
-        # Pre-calculate total and prepare all row data
-        total = 0.0
-        processed_rows = []
-        
-        set_font('small')
-        for i, row in enumerate(rows, 1):
-            desc = str(row.get('code_desc', '') or '').strip().upper()
-            
-            # Fast numeric conversion
+    # Sorted: set order follows PYTHONHASHSEED, and these lists feed the bill and its cache key
+    return {date: sorted(codes) for date, codes in service_date_diagnosis.items()}
+
+def data_version_time():
+    """Get the data file's modification time, used as the bill timestamp"""
+    return datetime.fromtimestamp(os.path.getmtime(FILE_PATH))
+
+def generate_pdf(rows, provider, location, service_date_icds, generated_at=None):
+    """Generate PDF bill for patient, spilling long service tables onto extra pages
+
+    generated_at is printed in the footer; pass the data version time so that
+    identical data always produces identical (cacheable) bills. The PDF is
+    written by the PDF_BACKEND renderer.
+    """
+    pages = bill_layout.plan_bill(rows, provider, location, service_date_icds,
+                                  generated_at or datetime.now())
+    return io.BytesIO(bill_render.render_pages(pages))
+
+def get_render_pool():
+    """Get the shared rendering process pool, or None when rendering in-process"""
+    global _render_pool
+    if RENDER_WORKERS <= 1:
+        return None
+    with _render_pool_lock:
+        if _render_pool is None:
+            # Imported on first use; multiprocessing is not needed to serve cached bills
+            from concurrent.futures import ProcessPoolExecutor
+            _render_pool = ProcessPoolExecutor(max_workers=RENDER_WORKERS)
+        return _render_pool
+
+def reset_render_pool():
+    """Drop a broken rendering pool so the next request starts a fresh one"""
+    global _render_pool
+    with _render_pool_lock:
+        if _render_pool is not None:
+            _render_pool.shutdown(wait=False, cancel_futures=True)
+            _render_pool = None
+
+def render_pdf_bytes(group_rows, provider, location, filtered_icds, generated_at=None):
+    """Render one bill to bytes"""
+    return generate_pdf(group_rows, provider, location, filtered_icds, generated_at).read()
+
+def render_pdf_timed(*args):
+    """Render one bill and report how long it took (also the process pool entry point)
+
+    The duration travels back with the PDF because metrics recorded inside a
+    pool process never reach the worker serving /metrics.
+    """
+    started = time.perf_counter()
+    pdf_bytes = render_pdf_bytes(*args)
+    return pdf_bytes, time.perf_counter() - started
+
+def safe_patient_id(patient_id):
+    """Make a patient ID safe to use in file and directory names"""
+    return str(patient_id).replace(' ', '_').replace('/', '-').replace('\\', '-')
+
+def patient_bills(patient_id, rows, generated_at=None):
+    """Split a patient's rows into per-date bills as (date_of_service, filename, render_args)
+
+    Nothing is looked up in the PDF cache, so exports can plan bills they will
+    always render.
+    """
+    # Extract service date and ICD codes
+    service_date_icds = extract_service_date_icd_codes(rows)
+
+    # Group rows by date of service
+    grouped = defaultdict(list)
+    for row in rows:
+        date_key = row.get('date_of_service', 'Unknown_Date')
+        grouped[date_key].append(row)
+
+    bills = []
+    for date_of_service, group_rows in grouped.items():
+        provider, location = extract_patient_data(group_rows)
+        filtered_icds = {date_of_service: service_date_icds.get(date_of_service, [])}
+
+        # Create safe filename - remove/replace problematic characters
+        safe_date = date_of_service.replace('/', '-').replace(' ', '_').replace(':', '-')
+        filename = f"bill_{safe_patient_id(patient_id)}_{safe_date}.pdf"
+
+        bills.append((date_of_service, filename, (group_rows, provider, location, filtered_icds, generated_at)))
+    return bills
+
+def bill_jobs(patient_id, rows, generated_at=None):
+    """Describe a patient's per-date bills as (patient_id, filename, cache_key, render_args, cached_pdf)
+
+    The cache key leaves out generated_at, so a reused PDF keeps the footer
+    timestamp of the data version it was first rendered from.
+    """
+    # ClaimRow tuples serialise as bare values, so their column names are hashed once per bill
+    headers = getattr(rows[0], 'headers', None) if rows else None
+
+    bill_specs = []
+    for date_of_service, filename, args in patient_bills(patient_id, rows, generated_at):
+        group_rows, provider, location, filtered_icds, _ = args
+        key = bill_cache.cache_key(
+            patient_id.lower(), date_of_service, bill_layout.LAYOUT_VERSION, bill_render.PDF_BACKEND,
+            bill_cache.content_hash(headers, group_rows, provider, location, filtered_icds)
+        )
+        bill_specs.append((patient_id, filename, key, args, PDF_CACHE.get(key)))
+    return bill_specs
+
+def _finish_bill_job(job, future):
+    """Wait for (or render) one bill and remember it in the PDF cache"""
+    patient_id, filename, key, args, pdf_bytes = job
+    if pdf_bytes is None:
+        try:
+            pdf_bytes, seconds = future.result() if future is not None else render_pdf_timed(*args)
+        except BrokenExecutor:
+            print("Warning: Render pool broke; rendering in-process")
+            reset_render_pool()
+            pdf_bytes, seconds = render_pdf_timed(*args)
+        metrics.observe('generate_pdf', seconds)
+        metrics.inc('pdfs_rendered')
+        PDF_CACHE.put(key, pdf_bytes)
+    return patient_id, filename, pdf_bytes
+
+def render_bill_jobs(bill_specs, use_pool=True):
+    """Yield (patient_id, filename, pdf_bytes) for each job, in job order
+
+    Cache misses are rendered in the process pool when use_pool is set, with at
+    most a few jobs per worker in flight so large batches keep memory bounded.
+    """
+    pool = get_render_pool() if use_pool else None
+    window = RENDER_WORKERS * 4
+    pending = deque()
+    for job in bill_specs:
+        future = None
+        if pool is not None and job[4] is None:
             try:
-                cost = float(row.get('Charges') or 0)
-            except (ValueError, TypeError):
-                cost = 0.0
-            
-            total += cost
-            
-            # Pre-process description for wrapping - simplified approach
-            desc_width_chars = 45  # Approximate characters that fit
-            
-            if len(desc) <= desc_width_chars:
-                desc_lines = [desc] if desc else [""]
-            else:
-                # Simple word wrapping - faster than complex calculations
-                words = desc.split()
-                desc_lines = []
-                current_line = ""
-                
-                for word in words:
-                    test_line = f"{current_line} {word}" if current_line else word
-                    if len(test_line) <= desc_width_chars:
-                        current_line = test_line
-                    else:
-                        if current_line:
-                            desc_lines.append(current_line)
-                        current_line = word
-                
-                if current_line:
-                    desc_lines.append(current_line)
-            
-            processed_rows.append({
-                'sr': str(i),
-                'date': str(row.get('date_of_service') or ''),
-                'code': str(row.get('code') or ''),
-                'desc_lines': desc_lines,
-                'modifier': str(row.get('code_modifier_1') or ''),
-                'units': str(row.get('ChargeUnits') or '1'),
-                'charge': f"${cost:,.2f}",
-                'cost': cost
-            })
-
-        # Draw all rows at once
-        for row_data in processed_rows:
-            # Draw first line with all columns
-            values = [row_data['sr'], row_data['date'], row_data['code'], 
-                     row_data['desc_lines'][0], row_data['modifier'], 
-                     row_data['units'], row_data['charge']]
-            
-            for j, val in enumerate(values):
-                c.drawString(col_positions[j], y, val)
-            
-            # Draw additional description lines if any
-            for desc_line in row_data['desc_lines'][1:]:
-                y -= 12
-                c.drawString(col_positions[3], y, desc_line)
-            
-            y -= 20
-
-        # Draw total
-        y -= 5
-        set_font('table_header')
-        c.drawString(col_positions[-2], y, "TOTAL:")
-        c.drawString(col_positions[-1], y, f"${total:,.2f}")
-        y -= 30
-
-    def draw_icd_section():
-        nonlocal y
-        set_font('section')
-        c.drawString(MARGIN_LEFT, y, "DIAGNOSIS CODES (ICD):")
-        y -= 20
-        
-        # Pre-process all ICD codes
-        all_icds = []
-        for icds in service_date_icds.values():
-            all_icds.extend(icds)
-        
-        # Remove duplicates while preserving order
-        unique_icds = list(dict.fromkeys(all_icds))
-        icd_text = ', '.join(unique_icds) if unique_icds else "N/A"
-        
-        set_font('small')
-        
-        # Simple line wrapping for ICD codes
-        max_chars = 80
-        if len(icd_text) <= max_chars:
-            c.drawString(MARGIN_LEFT, y, icd_text)
-            y -= 15
-        else:
-            words = icd_text.split(', ')
-            current_line = ""
-            
-            for word in words:
-                test_line = f"{current_line}, {word}" if current_line else word
-                if len(test_line) <= max_chars:
-                    current_line = test_line
-                else:
-                    if current_line:
-                        c.drawString(MARGIN_LEFT, y, current_line)
-                        y -= 15
-                    current_line = word
-            
-            if current_line:
-                c.drawString(MARGIN_LEFT, y, current_line)
-                y -= 15
-        
-        y -= 10
-
-    def draw_footer():
-        # Pre-format timestamp
-        timestamp = datetime.now().strftime("%B %d, %Y at %I:%M %p")
-        c.setFont("Helvetica-Oblique", 9)
-        c.drawString(MARGIN_LEFT, 30, f"Generated on {timestamp}")
-        c.drawRightString(width - MARGIN_RIGHT, 30, "Page 1")
-
-    # Execute all drawing operations
-    draw_title()
-    draw_patient_info()
-    draw_provider_info()
-    draw_services_table()
-    draw_icd_section()
-    draw_footer()
-
-    # Single save operation
-    c.save()
-    buffer.seek(0)
-    return buffer
+                future = pool.submit(render_pdf_timed, *job[3])
+            except BrokenExecutor:
+                reset_render_pool()
+                pool = None
+        pending.append((job, future))
+        # Results are consumed in submission order so the ZIP layout is deterministic
+        if len(pending) >= window:
+            yield _finish_bill_job(*pending.popleft())
+    while pending:
+        yield _finish_bill_job(*pending.popleft())
+
+def bill_files(patient_id, rows, on_progress=None):
+    """Yield (filename, pdf_bytes) for each date of service of a patient
+
+    Uncached dates are rendered in the process pool when there are at least
+    RENDER_POOL_MIN_DATES of them, and in-process otherwise so small patients
+    don't pay the pool overhead. on_progress(done, total) is called before the
+    first bill and after each one.
+    """
+    pending_jobs = bill_jobs(patient_id, rows, data_version_time())
+    misses = sum(1 for job in pending_jobs if job[4] is None)
+    if on_progress:
+        on_progress(0, len(pending_jobs))
+    results = render_bill_jobs(pending_jobs, use_pool=misses >= RENDER_POOL_MIN_DATES)
+    for done, (_, filename, pdf_bytes) in enumerate(results, 1):
+        yield filename, pdf_bytes
+        if on_progress:
+            on_progress(done, len(pending_jobs))
+
+def batch_files(patient_rows, layout='tree'):
+    """Yield (arcname, data) for a batch: a manifest, then every found patient's bills
+
+    layout 'tree' puts each patient's PDFs in its own directory; 'nested' gives
+    each patient a ZIP of its own.
+    """
+    found = [patient_id for patient_id, rows in patient_rows.items() if rows]
+    not_found = [patient_id for patient_id, rows in patient_rows.items() if not rows]
+    manifest = {
+        'generated_at': datetime.now().isoformat(),
+        'layout': layout,
+        'requested': len(patient_rows),
+        'found': found,
+        'not_found': not_found,
+    }
+    yield 'manifest.json', json.dumps(manifest, indent=2).encode('utf-8')
+
+    generated_at = data_version_time()
+    bill_specs = (job for patient_id in found for job in bill_jobs(patient_id, patient_rows[patient_id], generated_at))
+    results = render_bill_jobs(bill_specs)
+    if layout == 'nested':
+        for patient_id, patient_results in groupby(results, key=lambda result: result[0]):
+            files = [(filename, pdf_bytes) for _, filename, pdf_bytes in patient_results]
+            yield f"{safe_patient_id(patient_id)}_bills.zip", bill_zip.build_zip(files)
+    else:
+        for patient_id, filename, pdf_bytes in results:
+            yield f"{safe_patient_id(patient_id)}/{filename}", pdf_bytes
+
+def parse_patient_ids(values):
+    """Strip, drop blanks and de-duplicate patient IDs, keeping their order"""
+    return list(dict.fromkeys(value.strip() for value in values if value and value.strip()))
+
+def warm_index(progress):
+    """Wait for the patient index and catalog and pull the index into the page cache"""
+    progress(0, 2)
+    data_index.get_index(FILE_PATH, INDEX_PATH, wait=True)
+    warmup.read_through(INDEX_PATH)
+    progress(1, 2)
+    patient_catalog.get_catalog(FILE_PATH, CATALOG_PATH, wait=True)
+    progress(2, 2)
+
+# Every character class a bill prints, measured once per font at warm-up
+WARMUP_SAMPLE_TEXT = "ABCDEFGHIJKLMNOPQRSTUVWXYZ abcdefghijklmnopqrstuvwxyz 0123456789 $,.:#-/()&"
+
+def warm_fonts(progress):
+    """Load the Helvetica metrics every bill measures text with"""
+    progress(0, len(bill_layout.FONTS))
+    for done, font in enumerate(bill_layout.FONTS, 1):
+        bill_layout.text_width(WARMUP_SAMPLE_TEXT, font)
+        progress(done, len(bill_layout.FONTS))
+
+def warmup_patient_ids():
+    """Get the configured warm-up patients followed by the most recently active ones"""
+    patient_ids = list(WARMUP_PATIENTS)
+    if WARMUP_RECENT > 0:
+        catalog = patient_catalog.get_catalog(FILE_PATH, CATALOG_PATH, wait=True)
+        patient_ids += catalog.recent_patients(WARMUP_RECENT)
+    return parse_patient_ids(patient_ids)
+
+def warm_bills(progress):
+    """Render and cache the bill ZIPs of the warm-up patients, within WARMUP_MAX_SECONDS"""
+    patient_ids = warmup_patient_ids()
+    deadline = time.monotonic() + WARMUP_MAX_SECONDS
+    progress(0, len(patient_ids))
+    for done, patient_id in enumerate(patient_ids, 1):
+        if time.monotonic() > deadline:
+            print(f"Warning: Warm-up stopped after {done - 1} of {len(patient_ids)} patients "
+                  f"(WARMUP_MAX_SECONDS={WARMUP_MAX_SECONDS:g})")
+            break
+        cache_key = zip_cache_key(patient_id)
+        if cache_key is not None and cached_zip(cache_key) is None:
+            rows = search_rows(patient_id)
+            if rows:
+                stats = bill_zip.new_stats()
+                cache_zip(cache_key, bill_zip.build_zip(bill_files(patient_id, rows), stats=stats), stats)
+        progress(done, len(patient_ids))
+
+WARMUP_STATE = warmup.Warmup([
+    ('index', warm_index),
+    ('fonts', warm_fonts),
+    ('bills', warm_bills),
+])
+
+def start_warmup():
+    """Start warming this process's caches when WARMUP is on"""
+    if WARMUP and os.path.exists(FILE_PATH):
+        WARMUP_STATE.start()
 
 # Routes
 @app.route('/')
@@ -582,76 +763,381 @@ def serve_index():
 @app.route('/health')
 def health_check():
     """Health check endpoint for monitoring"""
+    payload, status = health_payload()
+    return jsonify(payload), status
+
+def health_payload():
+    """Build the health report and its HTTP status"""
     try:
         file_exists = os.path.exists(FILE_PATH)
-        return jsonify({
+        payload = {
             'status': 'healthy' if file_exists else 'degraded',
             'timestamp': datetime.now().isoformat(),
             'data_file_exists': file_exists,
             'data_file_path': FILE_PATH
-        })
+        }
+        if file_exists:
+            size, mtime_ns = data_index.data_file_signature(FILE_PATH)
+            payload['data_file'] = {
+                'size': size,
+                'modified': datetime.fromtimestamp(mtime_ns / 1e9).isoformat(),
+            }
+            index = data_index.index_status(FILE_PATH, INDEX_PATH)
+            if 'source_mtime' in index:
+                index['source_modified'] = datetime.fromtimestamp(index.pop('source_mtime')).isoformat()
+            payload['index'] = index
+        if WARMUP and file_exists:
+            # Processes that were not warmed up at startup start on their first health check
+            start_warmup()
+            payload['warmup'] = WARMUP_STATE.status()
+            if not WARMUP_STATE.is_done():
+                payload['status'] = 'warming_up'
+                return payload, 503
+        return payload, 200
     except Exception as e:
-        return jsonify({
+        return {
             'status': 'unhealthy',
             'error': str(e),
             'timestamp': datetime.now().isoformat()
-        }), 500
+        }, 500
+
+def current_catalog():
+    """Get the patient catalog, or None and a 503 response while there is none yet"""
+    if not os.path.exists(FILE_PATH):
+        return None, (jsonify({'error': f"Data file not found at {FILE_PATH}"}), 503)
+    catalog = patient_catalog.get_catalog(FILE_PATH, CATALOG_PATH, wait=False)
+    if catalog is None:
+        response = jsonify({'error': "The patient catalog is being built, please retry shortly"})
+        response.headers['Retry-After'] = '10'
+        return None, (response, 503)
+    return catalog, None
+
+@app.route('/search')
+def search_patients():
+    """Find patients by name, date of service range or rendering provider"""
+    name = request.args.get('name', '').strip()
+    provider = request.args.get('provider', '').strip()
+    date_bounds = {}
+    for param in ('date_from', 'date_to'):
+        value = request.args.get(param, '').strip()
+        if value:
+            date_bounds[param] = patient_catalog.date_key(value)
+            if date_bounds[param] is None:
+                return jsonify({'error': f"{param} is not a date: {value}"}), 400
+    for param, value in (('name', name), ('provider', provider)):
+        if value and not patient_catalog.search_tokens(value):
+            return jsonify({'error': f"{param} has no letters or digits to search for: {value}"}), 400
+    if not (name or provider or date_bounds):
+        return jsonify({'error': "Give at least one of name, provider, date_from or date_to"}), 400
+    try:
+        limit = min(int(request.args.get('limit', 50)), SEARCH_MAX_RESULTS)
+    except ValueError:
+        return jsonify({'error': "limit must be a number"}), 400
+
+    catalog, unavailable = current_catalog()
+    if catalog is None:
+        return unavailable
+
+    with metrics.span('search'):
+        results, truncated = catalog.search(name=name, provider=provider, limit=max(limit, 1), **date_bounds)
+    return jsonify({
+        'results': results,
+        'count': len(results),
+        'truncated': truncated,
+        # Results come from the previous generation while an updated catalog is built
+        'stale': not catalog.is_fresh(FILE_PATH),
+    })
+
+@app.route('/patient-summary')
+def patient_summary():
+    """Get a patient's line count, total charges, ICD codes and providers without rendering a bill"""
+    patient_id = request.args.get('patient_id', '').strip()
+    if not patient_id:
+        return jsonify({'error': "patient_id is required"}), 400
+    catalog, unavailable = current_catalog()
+    if catalog is None:
+        return unavailable
+
+    date_of_service = request.args.get('date_of_service')
+    with metrics.span('patient_summary'):
+        summary = catalog.summary(patient_id, date_of_service)
+    if summary is None:
+        return jsonify({'error': f"No records found for patient ID: {patient_id}"}), 404
+    if date_of_service is not None and not summary['dates']:
+        return jsonify({'error': f"No records found for patient ID {patient_id} "
+                                 f"on {date_of_service.strip()}"}), 404
+    summary['stale'] = not catalog.is_fresh(FILE_PATH)
+    return jsonify(summary)
+
+@app.route('/metrics')
+def metrics_endpoint():
+    """Per-stage timings and counters in Prometheus text format"""
+    body = metrics.render({'zip': BILL_CACHE, 'pdf': PDF_CACHE})
+    return Response(body, mimetype='text/plain; version=0.0.4')
+
+def zip_cache_key(patient_id):
+    """Get the bill cache key for a patient at the current data version, or None"""
+    if not os.path.exists(FILE_PATH):
+        return None
+    return bill_cache.cache_key(patient_id, bill_layout.LAYOUT_VERSION, bill_render.PDF_BACKEND,
+                                bill_zip.ZIP_COMPRESSION, bill_zip.AUTO_MIN_SAVING,
+                                *data_index.data_file_signature(FILE_PATH))
+
+def cached_zip(cache_key):
+    """Get (zip_bytes, stats) from the bill cache, or None"""
+    if cache_key is None:
+        return None
+    cached = BILL_CACHE.get(cache_key)
+    return bill_zip.unpack_cached(cached) if cached is not None else None
+
+def cache_zip(cache_key, zip_bytes, stats):
+    """Store a generated ZIP and its compression stats in the bill cache"""
+    if cache_key is not None:
+        BILL_CACHE.put(cache_key, bill_zip.pack_cached(zip_bytes, stats))
+
+def finish_streamed_zip(patient_id, stats, cache_key, chunks):
+    """Record a fully streamed ZIP and cache it, unless chunks is None (too big to keep)"""
+    metrics.observe('zip', stats['compress_seconds'])
+    # Headers are long gone, so streamed compression stats go to the log
+    print(f"Streamed {stats['entries']} bills for {patient_id}: {stats['compression']}, "
+          f"saved {stats['saved_bytes']} bytes in {stats['compress_seconds'] * 1000:.1f}ms")
+    if chunks is not None:
+        cache_zip(cache_key, b''.join(chunks), stats)
+
+def streamed_zip_response(patient_id, rows, download_name, cache_key=None):
+    """Stream the ZIP as each PDF finishes, caching it afterwards if it fits the cache"""
+    def generate():
+        kept = []
+        kept_size = 0
+        stats = bill_zip.new_stats()
+        try:
+            for chunk in bill_zip.stream_zip(bill_files(patient_id, rows), stats=stats):
+                if kept is not None:
+                    kept.append(chunk)
+                    kept_size += len(chunk)
+                    if kept_size > BILL_CACHE.max_bytes:
+                        kept = None
+                metrics.inc('bytes_out', len(chunk))
+                yield chunk
+        except Exception as e:
+            # Headers are already sent; the client sees a truncated download
+            print(f"Error streaming bills: {e}")
+            raise
+        finish_streamed_zip(patient_id, stats, cache_key, kept)
+
+    response = Response(generate(), mimetype='application/zip')
+    response.headers.set('Content-Disposition', 'attachment', filename=download_name)
+    return response
 
 @app.route('/patient-pdf')
 def patient_pdf():
     """Generate and return patient PDF bills as ZIP"""
+    with metrics.request_timings() as spans:
+        response = make_response(patient_pdf_response())
+    if SERVER_TIMING:
+        # Streamed ZIPs send headers before rendering, so they only carry the search time
+        response.headers['Server-Timing'] = metrics.server_timing(spans)
+    return response
+
+def patient_pdf_response():
+    """Build the /patient-pdf response for the requested patient"""
     patient_id = request.args.get('patient_id', '').strip()
     
     if not patient_id:
         return "Patient ID is required.", 400
     
+    # Create safe download filename
+    safe_download_name = f"{str(patient_id).replace(' ', '_')}_bills.zip"
+
+    # Serve a cached ZIP when this patient was already generated for the current data
+    cache_key = zip_cache_key(patient_id)
+    cached = cached_zip(cache_key)
+    if cached is not None:
+        zip_bytes, stats = cached
+        metrics.inc('bytes_out', len(zip_bytes))
+        with metrics.span('send_file'):
+            response = send_file(
+                io.BytesIO(zip_bytes),
+                mimetype='application/zip',
+                as_attachment=True,
+                download_name=safe_download_name
+            )
+        if stats is not None:
+            response.headers.extend(bill_zip.stats_headers(stats))
+        return response
+
     # Search for patient records
     rows = search_rows(patient_id)
     if not rows:
         return f"No records found for patient ID: {patient_id}", 404
+
+    if request.args.get('stream', '1' if STREAM_ZIPS else '0') == '1':
+        return streamed_zip_response(patient_id, rows, safe_download_name, cache_key)
     
     try:
-        # Extract service date and ICD codes
-        service_date_icds = extract_service_date_icd_codes(rows)
-        
-        # Group rows by date of service
-        grouped = defaultdict(list)
-        for row in rows:
-            date_key = row.get('date_of_service', 'Unknown_Date')
-            grouped[date_key].append(row)
-
         # Create ZIP file with all PDFs
-        zip_buffer = io.BytesIO()
-        with zipfile.ZipFile(zip_buffer, 'w', compression=zipfile.ZIP_DEFLATED, compresslevel=6) as zf:
-            for date_of_service, group_rows in grouped.items():
-                provider, location = extract_patient_data(group_rows)
-                filtered_icds = {date_of_service: service_date_icds.get(date_of_service, [])}
-                pdf_buffer = generate_pdf(group_rows, provider, location, filtered_icds)
-                
-                # Create safe filename - remove/replace problematic characters
-                safe_date = date_of_service.replace('/', '-').replace(' ', '_').replace(':', '-')
-                safe_patient_id = str(patient_id).replace(' ', '_').replace('/', '-').replace('\\', '-')
-                filename = f"bill_{safe_patient_id}_{safe_date}.pdf"
-                
-                zf.writestr(filename, pdf_buffer.read())
-        
-        zip_buffer.seek(0)
-        
-        # Create safe download filename
-        safe_download_name = f"{str(patient_id).replace(' ', '_')}_bills.zip"
+        stats = bill_zip.new_stats()
+        zip_bytes = bill_zip.build_zip(bill_files(patient_id, rows), stats=stats)
+        metrics.observe('zip', stats['compress_seconds'])
+        cache_zip(cache_key, zip_bytes, stats)
         
         # Return ZIP file
-        return send_file(
-            zip_buffer, 
-            mimetype='application/zip', 
-            as_attachment=True, 
-            download_name=safe_download_name
-        )
+        metrics.inc('bytes_out', len(zip_bytes))
+        with metrics.span('send_file'):
+            response = send_file(
+                io.BytesIO(zip_bytes), 
+                mimetype='application/zip', 
+                as_attachment=True, 
+                download_name=safe_download_name
+            )
+        response.headers.extend(bill_zip.stats_headers(stats))
+        return response
         
     except Exception as e:
         print(f"Error generating PDF: {e}")
         return f"Error generating bills: {str(e)}", 500
 
+def get_job_store():
+    """Get the job store, creating its directory on first use"""
+    global _job_store
+    with _job_lock:
+        if _job_store is None:
+            _job_store = jobs.JobStore(JOBS_DIR, ttl_seconds=JOB_TTL_HOURS * 3600)
+        return _job_store
+
+def get_job_executor():
+    """Get the background thread pool that runs bill jobs"""
+    global _job_executor
+    with _job_lock:
+        if _job_executor is None:
+            _job_executor = ThreadPoolExecutor(max_workers=JOB_WORKERS, thread_name_prefix='bill-job')
+        return _job_executor
+
+def run_bill_job(job_id, patient_id):
+    """Generate a patient's bills into the job's result file, recording progress"""
+    store = get_job_store()
+    result_path = store.result_path(job_id)
+    tmp_path = f"{result_path}.tmp"
+    try:
+        cache_key = zip_cache_key(patient_id)
+        cached = cached_zip(cache_key)
+        if cached is not None:
+            store.start(job_id, 1)
+            with open(tmp_path, 'wb') as out:
+                out.write(cached[0])
+            os.replace(tmp_path, result_path)
+            store.progress(job_id, 1)
+            store.finish(job_id, result_path)
+            return
+
+        rows = search_rows(patient_id)
+        if not rows:
+            store.fail(job_id, f"No records found for patient ID: {patient_id}")
+            return
+
+        def on_progress(done, total):
+            if done == 0:
+                store.start(job_id, total)
+            else:
+                store.progress(job_id, done)
+
+        stats = bill_zip.new_stats()
+        with open(tmp_path, 'wb') as out:
+            for chunk in bill_zip.stream_zip(bill_files(patient_id, rows, on_progress), stats=stats):
+                out.write(chunk)
+        os.replace(tmp_path, result_path)
+        if cache_key is not None and os.path.getsize(result_path) <= BILL_CACHE.max_bytes:
+            with open(result_path, 'rb') as f:
+                cache_zip(cache_key, f.read(), stats)
+        store.finish(job_id, result_path)
+    except Exception as e:
+        print(f"Error generating bills for job {job_id}: {e}")
+        store.fail(job_id, f"Error generating bills: {str(e)}")
+
+def job_payload(job):
+    """Describe a job for the JSON API"""
+    payload = {
+        'job_id': job['id'],
+        'patient_id': job['patient_id'],
+        'status': job['status'],
+        'done': job['done'],
+        'total': job['total'],
+        'status_url': url_for('job_status', job_id=job['id']),
+    }
+    if job['error']:
+        payload['error'] = job['error']
+    if job['status'] == jobs.DONE:
+        payload['download_url'] = url_for('job_download', job_id=job['id'])
+    return payload
+
+@app.route('/jobs', methods=['POST'])
+def create_job():
+    """Queue background generation of a patient's bills"""
+    payload = request.get_json(silent=True) or {}
+    patient_id = str(payload.get('patient_id') or request.values.get('patient_id', '')).strip()
+    if not patient_id:
+        return "Patient ID is required.", 400
+
+    store = get_job_store()
+    job_id = store.create(patient_id)
+    get_job_executor().submit(run_bill_job, job_id, patient_id)
+    return jsonify(job_payload(store.get(job_id))), 202
+
+@app.route('/jobs/<job_id>')
+def job_status(job_id):
+    """Report a job's progress"""
+    job = get_job_store().get(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+    return jsonify(job_payload(job))
+
+@app.route('/jobs/<job_id>/download')
+def job_download(job_id):
+    """Serve a finished job's ZIP"""
+    job = get_job_store().get(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+    if job['status'] != jobs.DONE or not os.path.exists(job['result_path']):
+        return jsonify({'error': f"Job is {job['status']}"}), 409
+    return send_file(
+        job['result_path'],
+        mimetype='application/zip',
+        as_attachment=True,
+        download_name=f"{str(job['patient_id']).replace(' ', '_')}_bills.zip"
+    )
+
+@app.route('/batch-pdf', methods=['POST'])
+def batch_pdf():
+    """Generate bills for many patients as one streamed ZIP with a manifest"""
+    payload = request.get_json(silent=True) or {}
+    patient_ids = payload.get('patient_ids')
+    if not isinstance(patient_ids, list) or not all(isinstance(value, str) for value in patient_ids):
+        return "A JSON body with a 'patient_ids' list is required.", 400
+    patient_ids = parse_patient_ids(patient_ids)
+    if not patient_ids:
+        return "At least one Patient ID is required.", 400
+    if len(patient_ids) > BATCH_MAX_PATIENTS:
+        return (f"At most {BATCH_MAX_PATIENTS} Patient IDs are allowed per batch; "
+                f"use 'python cli.py batch' for larger runs."), 400
+    layout = payload.get('layout', 'tree')
+    if layout not in ('tree', 'nested'):
+        return "Layout must be 'tree' or 'nested'.", 400
+
+    # One pass over the index (or data file) for every patient in the batch
+    patient_rows = search_many_rows(patient_ids)
+
+    def generate():
+        try:
+            yield from bill_zip.stream_zip(batch_files(patient_rows, layout))
+        except Exception as e:
+            print(f"Error streaming batch bills: {e}")
+            raise
+
+    response = Response(generate(), mimetype='application/zip')
+    response.headers.set('Content-Disposition', 'attachment',
+                         filename=f"batch_bills_{datetime.now().strftime('%Y%m%d_%H%M%S')}.zip")
+    return response
+
 @app.errorhandler(404)
 def not_found(error):
     """Handle 404 errors"""
@@ -673,5 +1159,7 @@ if __name__ == "__main__":
     print(f"File exists: {os.path.exists(FILE_PATH)}")
     print(f"Running on port: {port}")
     print(f"Debug mode: {debug}")
+    load_patient_index()
+    start_warmup()
     
     app.run(host='0.0.0.0', port=port, debug=debug)
\ No newline at end of file
@@ -0,0 +1,264 @@
+"""ASGI entry point for the Patient Bill Generator.
+
+Serves `/`, `/health` and `/patient-pdf` natively on the event loop, with file
+reads and bill rendering pushed to bounded executors, so health checks and
+cache hits keep answering while heavy generations run. Every other route is
+handed to the Flask app on a worker thread. Run it with any ASGI server, e.g.
+
+    gunicorn -k uvicorn.workers.UvicornWorker asgi:app
+"""
+import os
+import io
+import sys
+import json
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qs
+
+from werkzeug.datastructures import Headers
+
+import app as flask_app
+import bill_zip
+import metrics
+
+# Generations allowed at once; further requests get 503 + Retry-After
+ASYNC_MAX_GENERATIONS = int(os.environ.get('ASYNC_MAX_GENERATIONS', 4))
+ASYNC_RETRY_AFTER = int(os.environ.get('ASYNC_RETRY_AFTER', 5))
+ASYNC_IO_WORKERS = int(os.environ.get('ASYNC_IO_WORKERS', 4))
+# Cache lookups get their own threads, so hits never queue behind data file scans
+ASYNC_CACHE_WORKERS = int(os.environ.get('ASYNC_CACHE_WORKERS', 2))
+
+_io_executor = ThreadPoolExecutor(max_workers=ASYNC_IO_WORKERS, thread_name_prefix='asgi-io')
+_cache_executor = ThreadPoolExecutor(max_workers=ASYNC_CACHE_WORKERS, thread_name_prefix='asgi-cache')
+_render_executor = ThreadPoolExecutor(max_workers=ASYNC_MAX_GENERATIONS, thread_name_prefix='asgi-render')
+_wsgi_executor = ThreadPoolExecutor(max_workers=ASYNC_IO_WORKERS, thread_name_prefix='asgi-wsgi')
+_active_generations = 0
+_STREAM_END = object()
+
+
+async def _run(executor, func, *args):
+    return await asyncio.get_running_loop().run_in_executor(executor, func, *args)
+
+
+async def _send_response(send, status, body, content_type='text/html; charset=utf-8', headers=()):
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [(b'content-type', content_type.encode('latin-1')),
+                    (b'content-length', str(len(body)).encode('latin-1')),
+                    *[(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in headers]],
+    })
+    await send({'type': 'http.response.body', 'body': body})
+
+
+def _attachment_headers(download_name):
+    headers = Headers()
+    headers.set('Content-Disposition', 'attachment', filename=download_name)
+    return list(headers.items())
+
+
+async def index(scope, receive, send):
+    """Serve the main page"""
+    await _send_response(send, 200, flask_app.HTML_TEMPLATE.encode('utf-8'))
+
+
+async def health(scope, receive, send):
+    """Health check, answered directly on the event loop"""
+    payload, status = flask_app.health_payload()
+    await _send_response(send, status, json.dumps(payload).encode('utf-8'), 'application/json')
+
+
+async def patient_pdf(scope, receive, send):
+    """Generate and return patient PDF bills as ZIP without blocking the event loop"""
+    global _active_generations
+    query = parse_qs(scope.get('query_string', b'').decode('latin-1'))
+    patient_id = query.get('patient_id', [''])[0].strip()
+    if not patient_id:
+        await _send_response(send, 400, b"Patient ID is required.")
+        return
+
+    safe_download_name = f"{str(patient_id).replace(' ', '_')}_bills.zip"
+    cache_key = await _run(_cache_executor, flask_app.zip_cache_key, patient_id)
+    cached = await _run(_cache_executor, flask_app.cached_zip, cache_key)
+    if cached is not None:
+        zip_bytes, stats = cached
+        headers = _attachment_headers(safe_download_name)
+        if stats is not None:
+            headers += bill_zip.stats_headers(stats)
+        metrics.inc('bytes_out', len(zip_bytes))
+        await _send_response(send, 200, zip_bytes, 'application/zip', headers)
+        return
+
+    if _active_generations >= ASYNC_MAX_GENERATIONS:
+        await _send_response(send, 503, b"Server is busy generating bills, please retry shortly.",
+                             headers=[('Retry-After', str(ASYNC_RETRY_AFTER))])
+        return
+
+    _active_generations += 1
+    try:
+        rows = await _run(_io_executor, flask_app.search_rows, patient_id)
+        if not rows:
+            await _send_response(send, 404, f"No records found for patient ID: {patient_id}".encode('utf-8'))
+            return
+
+        stream = query.get('stream', ['1' if flask_app.STREAM_ZIPS else '0'])[0] == '1'
+        if stream:
+            await _stream_zip(send, patient_id, rows, safe_download_name, cache_key)
+            return
+
+        try:
+            zip_bytes, stats = await _run(_render_executor, _build_zip, patient_id, rows)
+        except Exception as e:
+            print(f"Error generating PDF: {e}")
+            await _send_response(send, 500, f"Error generating bills: {str(e)}".encode('utf-8'))
+            return
+        await _run(_cache_executor, flask_app.cache_zip, cache_key, zip_bytes, stats)
+        metrics.inc('bytes_out', len(zip_bytes))
+        await _send_response(send, 200, zip_bytes, 'application/zip',
+                             _attachment_headers(safe_download_name) + bill_zip.stats_headers(stats))
+    finally:
+        _active_generations -= 1
+
+
+def _build_zip(patient_id, rows):
+    stats = bill_zip.new_stats()
+    zip_bytes = bill_zip.build_zip(flask_app.bill_files(patient_id, rows), stats=stats)
+    metrics.observe('zip', stats['compress_seconds'])
+    return zip_bytes, stats
+
+
+async def _stream_zip(send, patient_id, rows, download_name, cache_key=None):
+    """Send each ZIP chunk as soon as the render executor produces it, caching the ZIP if it fits"""
+    stats = bill_zip.new_stats()
+    chunks = bill_zip.stream_zip(flask_app.bill_files(patient_id, rows), stats=stats)
+    kept = []
+    kept_size = 0
+    await send({
+        'type': 'http.response.start',
+        'status': 200,
+        'headers': [(b'content-type', b'application/zip'),
+                    *[(name.lower().encode('latin-1'), value.encode('latin-1'))
+                      for name, value in _attachment_headers(download_name)]],
+    })
+    try:
+        while True:
+            chunk = await _run(_render_executor, next, chunks, _STREAM_END)
+            if chunk is _STREAM_END:
+                break
+            if kept is not None:
+                kept.append(chunk)
+                kept_size += len(chunk)
+                if kept_size > flask_app.BILL_CACHE.max_bytes:
+                    kept = None
+            metrics.inc('bytes_out', len(chunk))
+            await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+        await _run(_cache_executor, flask_app.finish_streamed_zip, patient_id, stats, cache_key, kept)
+    except Exception as e:
+        # Headers are already sent; the client sees a truncated download
+        print(f"Error streaming bills: {e}")
+    finally:
+        chunks.close()
+    await send({'type': 'http.response.body', 'body': b''})
+
+
+async def _read_body(receive):
+    body = bytearray()
+    while True:
+        message = await receive()
+        body += message.get('body', b'')
+        if not message.get('more_body'):
+            return bytes(body)
+
+
+def _wsgi_environ(scope, body):
+    server_name, server_port = scope.get('server') or ('localhost', 80)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', ''),
+        'PATH_INFO': scope['path'],
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_NAME': str(server_name),
+        'SERVER_PORT': str(server_port),
+        'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+        'CONTENT_LENGTH': str(len(body)),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+    if scope.get('client'):
+        environ['REMOTE_ADDR'] = scope['client'][0]
+    for name, value in scope.get('headers', []):
+        name = name.decode('latin-1').upper().replace('-', '_')
+        value = value.decode('latin-1')
+        if name == 'CONTENT_TYPE':
+            environ['CONTENT_TYPE'] = value
+        elif name != 'CONTENT_LENGTH':
+            key = f"HTTP_{name}"
+            environ[key] = f"{environ[key]},{value}" if key in environ else value
+    return environ
+
+
+async def wsgi_fallback(scope, receive, send):
+    """Run any other route through the Flask app on a worker thread"""
+    environ = _wsgi_environ(scope, await _read_body(receive))
+    started = {}
+
+    def start_response(status, headers, exc_info=None):
+        started['status'] = int(status.split(' ', 1)[0])
+        started['headers'] = headers
+
+    result = await _run(_wsgi_executor, flask_app.app, environ, start_response)
+    chunks = iter(result)
+    try:
+        first = await _run(_wsgi_executor, next, chunks, _STREAM_END)
+        await send({
+            'type': 'http.response.start',
+            'status': started['status'],
+            'headers': [(name.lower().encode('latin-1'), value.encode('latin-1'))
+                        for name, value in started['headers']],
+        })
+        chunk = first
+        while chunk is not _STREAM_END:
+            await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+            chunk = await _run(_wsgi_executor, next, chunks, _STREAM_END)
+        await send({'type': 'http.response.body', 'body': b''})
+    finally:
+        if hasattr(result, 'close'):
+            await _run(_wsgi_executor, result.close)
+
+
+ROUTES = {
+    ('GET', '/'): index,
+    ('GET', '/health'): health,
+    ('GET', '/patient-pdf'): patient_pdf,
+}
+
+
+async def app(scope, receive, send):
+    """ASGI application"""
+    if scope['type'] == 'lifespan':
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                flask_app.load_patient_index()
+                flask_app.start_warmup()
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                for executor in (_io_executor, _cache_executor, _render_executor, _wsgi_executor):
+                    executor.shutdown(wait=False)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+    if scope['type'] != 'http':
+        return
+
+    handler = ROUTES.get((scope['method'], scope['path']))
+    if handler is None:
+        handler = wsgi_fallback
+    else:
+        # The request body is unused by the native routes
+        await _read_body(receive)
+    await handler(scope, receive, send)
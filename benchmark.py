@@ -0,0 +1,386 @@
+"""Benchmarks for the Patient Bill Generator.
+
+Generate a seeded synthetic data file (the real Financials.txt holds patient
+data that cannot be shared), time the bill pipeline against it and compare runs:
+
+    python benchmark.py generate bench/Financials.txt --size 500MB --seed 1
+    python benchmark.py run bench/Financials.txt --out results.json
+    python benchmark.py compare baseline.json results.json
+    python benchmark.py startup --runs 5 --budget 2.5
+"""
+import os
+import sys
+import json
+import time
+import random
+import shlex
+import socket
+import argparse
+import platform
+import resource
+import subprocess
+import urllib.error
+import urllib.request
+from datetime import datetime
+
+HEADERS = [
+    'claim_id', 'patient_id', 'patient_name', 'patient_dob', 'patient_address1', 'patient_city',
+    'patient_state', 'patient_zip', 'payer_name', 'rendering_first_name', 'rendering_last_name',
+    'rendering_npi', 'date_of_service', 'place_of_service', 'diagnosis_dxs', 'code', 'code_desc',
+    'code_modifier_1', 'ChargeUnits', 'Charges', 'claim_status',
+]
+
+PROCEDURES = [
+    ('99213', 'OFFICE OUTPATIENT VISIT EST PATIENT LOW MEDICAL DECISION MAKING'),
+    ('99214', 'OFFICE OUTPATIENT VISIT EST PATIENT MODERATE MEDICAL DECISION MAKING'),
+    ('99203', 'OFFICE OUTPATIENT NEW PATIENT LOW MEDICAL DECISION MAKING'),
+    ('93000', 'ELECTROCARDIOGRAM ROUTINE WITH AT LEAST 12 LEADS WITH INTERPRETATION AND REPORT'),
+    ('36415', 'COLLECTION OF VENOUS BLOOD BY VENIPUNCTURE'),
+    ('80053', 'COMPREHENSIVE METABOLIC PANEL'),
+    ('85025', 'BLOOD COUNT COMPLETE AUTOMATED AND AUTOMATED DIFFERENTIAL WBC COUNT'),
+    ('71046', 'RADIOLOGIC EXAMINATION CHEST 2 VIEWS'),
+    ('G0439', 'ANNUAL WELLNESS VISIT SUBSEQUENT'),
+]
+DIAGNOSES = ['E11.9', 'I10', 'E78.5', 'Z00.00', 'J06.9', 'M54.5', 'R05.9', 'K21.9', 'F41.1', 'N39.0']
+FIRST_NAMES = ['James', 'Mary', 'Robert', 'Patricia', 'John', 'Jennifer', 'Michael', 'Linda', 'David', 'Maria']
+LAST_NAMES = ['Smith', 'Johnson', 'Williams', 'Brown', 'Jones', 'Garcia', 'Miller', 'Davis', 'Lopez', 'Wilson']
+CITIES = [('Dallas', 'TX', '752'), ('Frisco', 'TX', '750'), ('Plano', 'TX', '750'), ('Austin', 'TX', '787')]
+PAYERS = ['MEDICARE', 'BLUE CROSS BLUE SHIELD', 'AETNA', 'UNITED HEALTHCARE', 'SELF PAY']
+
+# Patients whose rows are shuffled together before writing, so a patient's
+# lines are spread over a region of the file as in an export
+INTERLEAVE_PATIENTS = 500
+
+SIZE_UNITS = {'': 1, 'B': 1, 'KB': 1024, 'MB': 1024 ** 2, 'GB': 1024 ** 3}
+
+
+def parse_size(text):
+    """Parse a size such as 100MB or 2GB into bytes"""
+    text = text.strip().upper()
+    number = text.rstrip('KMGB')
+    return int(float(number) * SIZE_UNITS[text[len(number):]])
+
+
+def draw_count(rng, mean, distribution):
+    """Draw a positive count with the given mean from a named distribution"""
+    if distribution == 'constant':
+        return max(1, round(mean))
+    if distribution == 'uniform':
+        return rng.randint(1, max(1, round(2 * mean - 1)))
+    if distribution == 'exponential':
+        return 1 + round(rng.expovariate(1 / (mean - 1))) if mean > 1 else 1
+    if distribution == 'pareto':
+        # Heavy tail: most patients are small, a few have thousands of lines
+        alpha = 1.5
+        return max(1, round(rng.paretovariate(alpha) * mean * (alpha - 1) / alpha))
+    raise ValueError(f"Unknown distribution: {distribution}")
+
+
+def _patient_rows(rng, number, args):
+    """Yield the pipe-joined lines of one synthetic patient"""
+    patient_id = f"P{number:08d}"
+    first, last = rng.choice(FIRST_NAMES), rng.choice(LAST_NAMES)
+    city, state, zip_prefix = rng.choice(CITIES)
+    identity = [
+        patient_id, f"{last}, {first}", f"{rng.randint(1940, 2015)}-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}",
+        f"{rng.randint(100, 9999)} {rng.choice(LAST_NAMES)} Street", city, state,
+        f"{zip_prefix}{rng.randint(0, 99):02d}", rng.choice(PAYERS),
+    ]
+    rows = draw_count(rng, args.rows_per_patient, args.distribution)
+    dates = [f"{rng.randint(1, 12):02d}/{rng.randint(1, 28):02d}/{rng.randint(2021, 2024)}"
+             for _ in range(min(rows, draw_count(rng, args.dates_per_patient, args.distribution)))]
+    providers = [(rng.choice(FIRST_NAMES), rng.choice(LAST_NAMES), str(rng.randint(10 ** 9, 10 ** 10 - 1)))
+                 for _ in range(rng.randint(1, 3))]
+    for i in range(rows):
+        code, desc = rng.choice(PROCEDURES)
+        provider = rng.choice(providers)
+        yield '|'.join([
+            f"C{number:08d}{i:05d}", *identity, *provider,
+            dates[i % len(dates)], rng.choice(['11', '22', '21']),
+            ','.join(rng.sample(DIAGNOSES, rng.randint(1, 3))), code, desc,
+            rng.choice(['', '', '25', '59']), str(rng.randint(1, 3)), f"{rng.uniform(15, 900):.2f}",
+            rng.choice(['PAID', 'DENIED', 'PENDING']),
+        ])
+
+
+def generate_command(args):
+    """Write a seeded synthetic data file of about the requested size"""
+    target = parse_size(args.size)
+    rng = random.Random(args.seed)
+    started = time.perf_counter()
+    written = rows = patients = 0
+    os.makedirs(os.path.dirname(os.path.abspath(args.out)), exist_ok=True)
+    with open(args.out, 'w', encoding='utf-8', newline='') as f:
+        written += f.write('|'.join(HEADERS) + '\n')
+        while written < target:
+            batch = []
+            for _ in range(INTERLEAVE_PATIENTS):
+                patients += 1
+                batch.extend(_patient_rows(rng, patients, args))
+            rng.shuffle(batch)
+            for line in batch:
+                written += f.write(line + '\n')
+                rows += 1
+                if written >= target:
+                    break
+    print(f"Wrote {rows} rows for {patients} patients ({written / 1024 ** 2:.0f} MB) "
+          f"in {time.perf_counter() - started:.1f}s -> {args.out}")
+
+
+def percentile(values, fraction):
+    """Linearly interpolated percentile of a sorted list"""
+    if not values:
+        return None
+    position = (len(values) - 1) * fraction
+    low = int(position)
+    high = min(low + 1, len(values) - 1)
+    return values[low] + (values[high] - values[low]) * (position - low)
+
+
+def peak_rss_mb():
+    """Peak resident set size of this process and its finished children, in MB"""
+    divisor = 1024 ** 2 if sys.platform == 'darwin' else 1024  # ru_maxrss is bytes on macOS, KB elsewhere
+    return {'self': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / divisor, 1),
+            'children': round(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / divisor, 1)}
+
+
+class StageTimer:
+    """Collect latencies and processed item counts for one benchmark stage"""
+
+    def __init__(self, name):
+        self.name = name
+        self.latencies = []
+        self.items = 0
+        self.peak_rss = None
+
+    def time(self, func, *args, items=lambda result: 1):
+        started = time.perf_counter()
+        result = func(*args)
+        self.latencies.append(time.perf_counter() - started)
+        self.items += items(result)
+        self.peak_rss = peak_rss_mb()
+        return result
+
+    def summary(self):
+        latencies = sorted(self.latencies)
+        total = sum(latencies)
+        return {
+            'calls': len(latencies),
+            'items': self.items,
+            'total_seconds': round(total, 4),
+            'calls_per_second': round(len(latencies) / total, 2) if total else None,
+            'items_per_second': round(self.items / total, 2) if total else None,
+            **{f"p{p}_ms": round(percentile(latencies, p / 100) * 1000, 3) if latencies else None
+               for p in (50, 95, 99)},
+            'max_ms': round(latencies[-1] * 1000, 3) if latencies else None,
+            'peak_rss_mb': self.peak_rss,
+        }
+
+
+def run_command(args):
+    """Time each stage of bill generation against a data file and write JSON results"""
+    # Imported here so the generator does not need Flask or ReportLab
+    import app
+    import bill_cache
+    import bill_render
+    import data_index
+
+    app.configure_data_paths(args.data, args.index, args.store)
+    if not args.warm_cache:
+        # Every request takes the full path unless cached bills are being measured
+        app.BILL_CACHE = bill_cache.BillCache(0)
+        app.PDF_CACHE = bill_cache.BillCache(0)
+
+    started = time.perf_counter()
+    index = data_index.get_index(app.FILE_PATH, app.INDEX_PATH)
+    index_seconds = time.perf_counter() - started
+    keys = list(index.keys())
+    patient_ids = random.Random(args.seed).sample(keys, min(args.patients, len(keys)))
+
+    stages = {name: StageTimer(name) for name in (
+        'search_rows', 'extract_service_date_icd_codes', 'generate_pdf', 'patient_pdf')}
+    generated_at = app.data_version_time()
+    for patient_id in patient_ids:
+        rows = stages['search_rows'].time(app.search_rows, patient_id, items=len)
+        stages['extract_service_date_icd_codes'].time(app.extract_service_date_icd_codes, rows, items=lambda _: len(rows))
+        for job in app.bill_jobs(patient_id, rows, generated_at):
+            stages['generate_pdf'].time(app.render_pdf_bytes, *job[3], items=len)
+
+    client = app.app.test_client()
+    for patient_id in patient_ids:
+        def request():
+            response = client.get('/patient-pdf', query_string={'patient_id': patient_id})
+            if response.status_code != 200:
+                raise RuntimeError(f"/patient-pdf returned {response.status_code} for {patient_id}")
+            return response.get_data()
+        stages['patient_pdf'].time(request, items=len)
+    app.reset_render_pool()
+
+    results = {
+        'created_at': datetime.now().isoformat(),
+        'data': {
+            'path': os.path.abspath(app.FILE_PATH),
+            'bytes': os.path.getsize(app.FILE_PATH),
+            'rows': index.meta['entries'],
+            'patients': index.meta['keys'],
+        },
+        'config': {
+            'patients_sampled': len(patient_ids),
+            'seed': args.seed,
+            'warm_cache': args.warm_cache,
+            'pdf_backend': bill_render.PDF_BACKEND,
+            'render_workers': app.RENDER_WORKERS,
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+        },
+        'index_seconds': round(index_seconds, 3),
+        'stages': {name: timer.summary() for name, timer in stages.items()},
+        'peak_rss_mb': peak_rss_mb(),
+    }
+    with open(args.out, 'w', encoding='utf-8') as f:
+        json.dump(results, f, indent=2)
+    for name, summary in results['stages'].items():
+        print(f"{name:32} p50 {summary['p50_ms']:>9} ms  p95 {summary['p95_ms']:>9} ms  "
+              f"p99 {summary['p99_ms']:>9} ms  {summary['calls_per_second']} calls/s")
+    print(f"Peak RSS {results['peak_rss_mb']['self']} MB -> {args.out}")
+
+
+def compare_command(args):
+    """Print the change in stage latencies and throughput between two result files"""
+    with open(args.baseline, encoding='utf-8') as f:
+        baseline = json.load(f)
+    with open(args.current, encoding='utf-8') as f:
+        current = json.load(f)
+    for name, now in current['stages'].items():
+        before = baseline['stages'].get(name)
+        if before is None:
+            continue
+        changes = []
+        for metric in ('p50_ms', 'p95_ms', 'p99_ms', 'calls_per_second'):
+            if before[metric] and now[metric] is not None:
+                changes.append(f"{metric} {before[metric]} -> {now[metric]} "
+                               f"({(now[metric] / before[metric] - 1) * 100:+.1f}%)")
+        print(f"{name}: " + ', '.join(changes))
+    print(f"peak_rss_mb {baseline['peak_rss_mb']['self']} -> {current['peak_rss_mb']['self']}")
+
+
+# Modules a worker should not import until it first renders a bill
+LAZY_MODULES = ('reportlab', 'concurrent.futures.process', 'multiprocessing')
+# Prints which of the modules named on its command line importing the app loaded
+IMPORT_PROBE = """
+import sys, json
+import app
+print(json.dumps([name for name in sys.argv[1:] if name in sys.modules]))
+"""
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def time_to_healthy(command, port, timeout):
+    """Start the server and return the seconds until /health first answers 200"""
+    env = dict(os.environ, PORT=str(port))
+    started = time.perf_counter()
+    server = subprocess.Popen(shlex.split(command.format(port=port)), env=env,
+                              cwd=os.path.dirname(os.path.abspath(__file__)),
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        while time.perf_counter() - started < timeout:
+            if server.poll() is not None:
+                raise RuntimeError(f"Server exited with status {server.returncode} before becoming healthy")
+            try:
+                with urllib.request.urlopen(f"http://127.0.0.1:{port}/health", timeout=1) as response:
+                    if response.status == 200:
+                        return time.perf_counter() - started
+            except (urllib.error.URLError, ConnectionError, socket.timeout):
+                pass
+            time.sleep(0.01)
+        raise RuntimeError(f"/health did not answer 200 within {timeout:g}s")
+    finally:
+        server.terminate()
+        try:
+            server.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            server.kill()
+            server.wait()
+
+
+def startup_command(args):
+    """Measure the time from process start to the first healthy /health and check a budget"""
+    seconds = sorted(time_to_healthy(args.command, free_port(), args.timeout) for _ in range(args.runs))
+    # Which heavy modules a plain import of the app already pulls in
+    probe = subprocess.run([sys.executable, '-c', IMPORT_PROBE, *LAZY_MODULES],
+                           cwd=os.path.dirname(os.path.abspath(__file__)),
+                           capture_output=True, text=True, check=True)
+    eager = json.loads(probe.stdout.strip().splitlines()[-1])
+    results = {
+        'created_at': datetime.now().isoformat(),
+        'command': args.command,
+        'runs': args.runs,
+        'budget_seconds': args.budget,
+        **{f"p{p}_seconds": round(percentile(seconds, p / 100), 3) for p in (50, 95)},
+        'max_seconds': round(seconds[-1], 3),
+        'eager_heavy_modules': eager,
+    }
+    if args.out:
+        with open(args.out, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2)
+    print(f"First healthy /health after p50 {results['p50_seconds']}s, max {results['max_seconds']}s "
+          f"over {args.runs} starts")
+    if eager:
+        print(f"Imported at startup although only needed for rendering: {', '.join(eager)}")
+    if args.budget is not None and results['p50_seconds'] > args.budget:
+        print(f"Startup budget of {args.budget:g}s exceeded")
+        return 1
+    return 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Patient Bill Generator benchmarks")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    generate = commands.add_parser('generate', help="Write a synthetic pipe-delimited data file")
+    generate.add_argument('out', help="Output data file")
+    generate.add_argument('--size', default='100MB', help="Approximate file size, e.g. 100MB or 2GB")
+    generate.add_argument('--seed', type=int, default=1)
+    generate.add_argument('--rows-per-patient', type=float, default=40, help="Mean claim lines per patient")
+    generate.add_argument('--dates-per-patient', type=float, default=6, help="Mean dates of service per patient")
+    generate.add_argument('--distribution', choices=('constant', 'uniform', 'exponential', 'pareto'),
+                          default='exponential', help="Shape of the per-patient row and date counts")
+    generate.set_defaults(func=generate_command)
+
+    run = commands.add_parser('run', help="Time search, ICD extraction, PDF rendering and /patient-pdf")
+    run.add_argument('data', help="Data file to benchmark against")
+    run.add_argument('--out', default='benchmark.json', help="JSON results file")
+    run.add_argument('--index', default=None, help="Patient index file (default: <data>.idx)")
+    run.add_argument('--store', default=None, help="Columnar store file (default: <data>.col)")
+    run.add_argument('--patients', type=int, default=50, help="Patients sampled from the index")
+    run.add_argument('--seed', type=int, default=1)
+    run.add_argument('--warm-cache', action='store_true', help="Keep the bill caches enabled")
+    run.set_defaults(func=run_command)
+
+    compare = commands.add_parser('compare', help="Compare two result files")
+    compare.add_argument('baseline')
+    compare.add_argument('current')
+    compare.set_defaults(func=compare_command)
+
+    startup = commands.add_parser('startup', help="Time from server start to the first healthy /health")
+    startup.add_argument('--command', default=f"{sys.executable} app.py",
+                         help="Server command; PORT is set in its environment and {port} is substituted")
+    startup.add_argument('--runs', type=int, default=5)
+    startup.add_argument('--budget', type=float, default=None,
+                         help="Fail when the median startup takes longer than this many seconds")
+    startup.add_argument('--timeout', type=float, default=120, help="Give up on a start after this many seconds")
+    startup.add_argument('--out', default=None, help="JSON results file")
+    startup.set_defaults(func=startup_command)
+
+    args = parser.parse_args(argv)
+    return args.func(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,135 @@
+import os
+import json
+import hashlib
+import threading
+from collections import OrderedDict
+
+# The disk tier is trimmed to this fraction of its limit, so the directory is
+# only rescanned after that much more has been written
+DISK_TRIM_TARGET = 0.9
+
+
+def cache_key(*parts):
+    """Build a stable cache key from its parts"""
+    return hashlib.sha256('|'.join(str(part) for part in parts).encode('utf-8')).hexdigest()
+
+
+def content_hash(*parts):
+    """Hash JSON-serialisable content, e.g. the rows a bill is rendered from"""
+    encoded = json.dumps(parts, sort_keys=True, separators=(',', ':'), default=str)
+    return hashlib.sha256(encoded.encode('utf-8')).hexdigest()
+
+
+class BillCache:
+    """Size-bounded LRU cache of generated bytes, with an optional on-disk tier.
+
+    Memory entries are evicted least-recently-used first once their total size
+    exceeds max_bytes. When disk_dir is set, entries are also written there so
+    they survive worker restarts; that tier is trimmed by file access time.
+    Its size is estimated from this process's writes since the last trim, so
+    workers sharing a directory can overshoot disk_max_bytes by a few entries.
+    """
+
+    def __init__(self, max_bytes, disk_dir=None, disk_max_bytes=None, suffix='.bin'):
+        self.max_bytes = max_bytes
+        self.disk_dir = disk_dir
+        self.disk_max_bytes = disk_max_bytes
+        self.suffix = suffix
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._size = 0
+        self._disk_size = None  # unknown until the directory is first scanned
+        self._lock = threading.Lock()
+        if disk_dir:
+            os.makedirs(disk_dir, exist_ok=True)
+
+    def _disk_path(self, key):
+        return os.path.join(self.disk_dir, f"{key}{self.suffix}")
+
+    def get(self, key):
+        """Return cached bytes for key, or None"""
+        with self._lock:
+            data = self._entries.get(key)
+            if data is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return data
+        if self.disk_dir:
+            path = self._disk_path(key)
+            try:
+                with open(path, 'rb') as f:
+                    data = f.read()
+                os.utime(path)
+            except OSError:
+                data = None
+            if data is not None:
+                self._remember(key, data)
+                with self._lock:
+                    self.hits += 1
+                return data
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def put(self, key, data):
+        """Store bytes under key in memory and, if enabled, on disk"""
+        self._remember(key, data)
+        if self.disk_dir:
+            path = self._disk_path(key)
+            tmp_path = f"{path}.tmp{os.getpid()}-{threading.get_ident()}"
+            try:
+                with open(tmp_path, 'wb') as f:
+                    f.write(data)
+                os.replace(tmp_path, path)
+                self._trim_disk(len(data))
+            except OSError as e:
+                print(f"Warning: Could not write bill cache entry: {e}")
+
+    def _remember(self, key, data):
+        if len(data) > self.max_bytes:
+            return
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self._size -= len(previous)
+            self._entries[key] = data
+            self._size += len(data)
+            while self._size > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._size -= len(evicted)
+
+    def _trim_disk(self, written):
+        if not self.disk_max_bytes:
+            return
+        with self._lock:
+            if self._disk_size is not None:
+                self._disk_size += written
+                if self._disk_size <= self.disk_max_bytes:
+                    return
+        entries = []
+        total = 0
+        with os.scandir(self.disk_dir) as it:
+            for entry in it:
+                if entry.name.endswith(self.suffix):
+                    st = entry.stat()
+                    entries.append((st.st_atime, st.st_size, entry.path))
+                    total += st.st_size
+        if total > self.disk_max_bytes:
+            target = self.disk_max_bytes * DISK_TRIM_TARGET
+            for _, size, path in sorted(entries):
+                if total <= target:
+                    break
+                try:
+                    os.remove(path)
+                except OSError:
+                    continue
+                total -= size
+        with self._lock:
+            self._disk_size = total
+
+    def stats(self):
+        """Return hit/miss counters and the current memory footprint"""
+        with self._lock:
+            return {'entries': len(self._entries), 'bytes': self._size,
+                    'hits': self.hits, 'misses': self.misses}
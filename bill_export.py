@@ -0,0 +1,239 @@
+import os
+import glob
+import json
+import heapq
+import shutil
+import signal
+import struct
+import tempfile
+import threading
+import time
+from collections import deque
+from datetime import datetime
+from itertools import groupby
+
+import app
+import bill_layout
+import bill_render
+import data_index
+from claim_row import claim_row_type
+
+# Rough per-row bookkeeping cost on top of the record bytes, for the memory budget
+ROW_OVERHEAD = 96
+CHECKPOINT_NAME = '.export-checkpoint.json'
+RUNS_PREFIX = '.export-runs-'
+CHECKPOINT_SECONDS = 10
+_RUN_RECORD = struct.Struct('<HQI')
+
+
+def _write_run(path, records):
+    """Write (patient_key, seq, body) records, already sorted, to a spill file"""
+    with open(path, 'wb') as f:
+        for key, seq, body in records:
+            encoded = key.encode('utf-8')
+            f.write(_RUN_RECORD.pack(len(encoded), seq, len(body)))
+            f.write(encoded)
+            f.write(body)
+
+
+def _read_run(path):
+    """Read back the records of one spill file in their sorted order"""
+    with open(path, 'rb') as f:
+        while True:
+            head = f.read(_RUN_RECORD.size)
+            if not head:
+                return
+            key_length, seq, body_length = _RUN_RECORD.unpack(head)
+            key = f.read(key_length).decode('utf-8')
+            yield key, seq, f.read(body_length)
+
+
+def sorted_records(data_path, run_dir, memory_bytes, skip_through=None):
+    """Yield (patient_key, seq, body) for every record, ordered by patient then file order
+
+    One pass over the data file. Records are buffered until memory_bytes is
+    reached, then sorted and spilled to a run file in run_dir; the runs are
+    merged at the end. Patients whose key sorts at or before skip_through
+    (already exported) are dropped while scanning.
+    """
+    with open(data_path, 'rb') as f:
+        headers, data_start = data_index.read_header(f)
+        pid_col = data_index.patient_column(headers)
+        if pid_col is None:
+            return
+        runs = []
+        buffer = []
+        buffered = 0
+        for seq, (_, body) in enumerate(data_index.iter_records(f, data_start)):
+            cols = data_index.parse_record(body, headers)
+            if cols is None:
+                continue
+            key = cols[pid_col].lower()
+            if skip_through is not None and key <= skip_through:
+                continue
+            buffer.append((key, seq, body))
+            buffered += len(body) + len(key) + ROW_OVERHEAD
+            if buffered >= memory_bytes:
+                buffer.sort()
+                runs.append(os.path.join(run_dir, f"run{len(runs):05d}"))
+                _write_run(runs[-1], buffer)
+                buffer = []
+                buffered = 0
+    buffer.sort()
+    yield from heapq.merge(*(_read_run(path) for path in runs), buffer)
+
+
+def patient_groups(data_path, run_dir, memory_bytes, skip_through=None):
+    """Yield (patient_key, rows) per patient, in patient key order, rows in file order"""
+    with open(data_path, 'rb') as f:
+        headers, _ = data_index.read_header(f)
+    row_type = claim_row_type(headers)
+    records = sorted_records(data_path, run_dir, memory_bytes, skip_through)
+    for key, group in groupby(records, key=lambda record: record[0]):
+        yield key, [row_type(data_index.parse_record(body, headers)) for _, _, body in group]
+
+
+def write_bill(path, render_args):
+    """Render one bill and write it atomically (also the writer pool entry point)"""
+    pdf_bytes = app.render_pdf_bytes(*render_args)
+    tmp_path = f"{path}.tmp{os.getpid()}"
+    with open(tmp_path, 'wb') as out:
+        out.write(pdf_bytes)
+    os.replace(tmp_path, path)
+    return len(pdf_bytes)
+
+
+class Checkpoint:
+    """Export progress saved in the output directory so an interrupted run can resume.
+
+    Patients are exported in key order, so everything up to last_patient_key
+    is known to be on disk. The data file's signature and the bill layout are
+    recorded too; resuming against anything else would mix bill versions.
+    """
+
+    def __init__(self, out_dir, data_path):
+        self.path = os.path.join(out_dir, CHECKPOINT_NAME)
+        size, mtime_ns = data_index.data_file_signature(data_path)
+        self.identity = {
+            'data_path': os.path.abspath(data_path),
+            'source_size': size,
+            'source_mtime_ns': mtime_ns,
+            'layout_version': bill_layout.LAYOUT_VERSION,
+            'pdf_backend': bill_render.PDF_BACKEND,
+        }
+        self.state = {'last_patient_key': None, 'patients': 0, 'bills': 0, 'bytes': 0, 'complete': False}
+        self._saved_at = time.monotonic()
+
+    def load(self):
+        """Resume from a saved checkpoint, if any; raises ValueError when it belongs to other data"""
+        try:
+            with open(self.path, encoding='utf-8') as f:
+                saved = json.load(f)
+        except FileNotFoundError:
+            return False
+        if any(saved.get(name) != value for name, value in self.identity.items()):
+            raise ValueError(f"{self.path} was written for a different data file or bill layout; "
+                             f"pass --restart to export from scratch")
+        self.state = {name: saved[name] for name in self.state}
+        return True
+
+    def advance(self, patient_key, bills, written):
+        """Record a patient whose bills are all written, saving every CHECKPOINT_SECONDS"""
+        # One assignment, so an interrupt never leaves a half-updated state to be saved
+        self.state = dict(self.state, last_patient_key=patient_key, patients=self.state['patients'] + 1,
+                          bills=self.state['bills'] + bills, bytes=self.state['bytes'] + written)
+        if time.monotonic() - self._saved_at >= CHECKPOINT_SECONDS:
+            self.save()
+
+    def save(self):
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({**self.identity, **self.state, 'updated_at': datetime.now().isoformat()}, f, indent=2)
+        os.replace(tmp_path, self.path)
+        self._saved_at = time.monotonic()
+
+
+def _interrupt(signum, frame):
+    raise KeyboardInterrupt(f"Export stopped by {signal.Signals(signum).name}")
+
+
+def _catch_stop_signals():
+    """Turn SIGTERM and SIGINT into KeyboardInterrupt; returns the handlers to restore"""
+    if threading.current_thread() is not threading.main_thread():
+        return {}
+    return {signum: signal.signal(signum, _interrupt) for signum in (signal.SIGTERM, signal.SIGINT)}
+
+
+def export_bills(data_path, out_dir, workers=None, memory_mb=256, tmp_dir=None, restart=False,
+                 progress=print):
+    """Write every patient's bills to out_dir/<patient>/bill_<patient>_<date>.pdf
+
+    Bills are rendered and written by a pool of worker processes with a bounded
+    number in flight. Returns the checkpoint state once the export is complete.
+    SIGTERM and SIGINT raise KeyboardInterrupt after the checkpoint is saved.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    # Spilled runs of a killed export are useless to the next one
+    for stale in glob.glob(os.path.join(out_dir, f"{RUNS_PREFIX}*")):
+        shutil.rmtree(stale, ignore_errors=True)
+    checkpoint = Checkpoint(out_dir, data_path)
+    if not restart and checkpoint.load():
+        if checkpoint.state['complete']:
+            return checkpoint.state
+        progress(f"Resuming after {checkpoint.state['patients']} patients "
+                 f"({checkpoint.state['bills']} bills) already exported")
+
+    workers = workers or app.RENDER_WORKERS
+    pool = None
+    if workers > 1:
+        from concurrent.futures import ProcessPoolExecutor
+        pool = ProcessPoolExecutor(max_workers=workers)
+    window = max(1, workers) * 4
+    generated_at = app.data_version_time()
+    run_dir = tempfile.mkdtemp(prefix=RUNS_PREFIX, dir=tmp_dir or out_dir)
+    # Patients with bills still being written, oldest first: (key, results)
+    pending = deque()
+    in_flight = 0
+    started = time.perf_counter()
+
+    def finish_oldest():
+        nonlocal in_flight
+        key, results = pending.popleft()
+        written = sum(result.result() if pool is not None else result for result in results)
+        in_flight -= len(results)
+        checkpoint.advance(key, len(results), written)
+        if checkpoint.state['patients'] % 1000 == 0:
+            progress(f"Exported {checkpoint.state['patients']} patients, {checkpoint.state['bills']} bills "
+                     f"in {time.perf_counter() - started:.0f}s")
+
+    previous_handlers = _catch_stop_signals()
+    try:
+        groups = patient_groups(data_path, run_dir, memory_mb * 1024 * 1024,
+                                checkpoint.state['last_patient_key'])
+        for key, rows in groups:
+            patient_id = rows[0].get('patient_id', key)
+            patient_dir = os.path.join(out_dir, app.safe_patient_id(patient_id))
+            os.makedirs(patient_dir, exist_ok=True)
+            results = []
+            for _, filename, render_args in app.patient_bills(patient_id, rows, generated_at):
+                path = os.path.join(patient_dir, filename)
+                if pool is not None:
+                    results.append(pool.submit(write_bill, path, render_args))
+                else:
+                    results.append(write_bill(path, render_args))
+            pending.append((key, results))
+            in_flight += len(results)
+            while in_flight > window:
+                finish_oldest()
+        while pending:
+            finish_oldest()
+        checkpoint.state['complete'] = True
+    finally:
+        for signum, handler in previous_handlers.items():
+            signal.signal(signum, handler)
+        # Only patients whose bills all finished are recorded, so a resumed run redoes the rest
+        checkpoint.save()
+        if pool is not None:
+            pool.shutdown(cancel_futures=True)
+        shutil.rmtree(run_dir, ignore_errors=True)
+    return checkpoint.state
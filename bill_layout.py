@@ -0,0 +1,233 @@
+from functools import lru_cache
+
+# Bumped whenever the layout changes, so cached bills are re-rendered
+LAYOUT_VERSION = 6
+
+# US Letter in points, as reportlab.lib.pagesizes.LETTER; ReportLab itself is
+# only imported once text is first measured, keeping it out of worker startup
+PAGE_WIDTH, PAGE_HEIGHT = 612.0, 792.0
+MARGIN_LEFT = 50
+MARGIN_RIGHT = 50
+TOP = PAGE_HEIGHT - 60
+# Lowest baseline for body text; the footer sits below it
+BOTTOM = 60
+FOOTER_Y = 30
+
+FONTS = {
+    'title': ('Helvetica-Bold', 16),
+    'section': ('Helvetica-Bold', 12),
+    'normal': ('Helvetica', 11),
+    'small': ('Helvetica', 9),
+    'table_header': ('Helvetica-Bold', 11),
+    'footer': ('Helvetica-Oblique', 9),
+}
+
+TABLE_HEADERS = ["Sr.", "Date", "Code", "Description", "Modifier", "Units", "Charge"]
+COL_POSITIONS = [MARGIN_LEFT, MARGIN_LEFT + 25, MARGIN_LEFT + 85,
+                 MARGIN_LEFT + 130, MARGIN_LEFT + 400, MARGIN_LEFT + 450, MARGIN_LEFT + 490]
+DESC_WIDTH = COL_POSITIONS[4] - COL_POSITIONS[3] - 5
+ICD_WIDTH = PAGE_WIDTH - MARGIN_LEFT - MARGIN_RIGHT
+
+# Clinic address printed on every bill
+CLINIC_LOCATION = "9741 Preston Road Frisco, TX 75033-2793, (972) 335-2004"
+
+# Baselines of the fixed first-page block and of continuation page headers
+TITLE_Y = TOP
+PATIENT_HEADING_Y = TITLE_Y - 40
+NAME_Y = PATIENT_HEADING_Y - 20
+ADDRESS_Y = NAME_Y - 18
+PROVIDER_HEADING_Y = ADDRESS_Y - 30
+PROVIDER_Y = PROVIDER_HEADING_Y - 20
+LOCATION_Y = PROVIDER_Y - 18
+SERVICES_HEADING_Y = LOCATION_Y - 30
+TABLE_HEADER_Y = SERVICES_HEADING_Y - 25
+ROWS_TOP = TABLE_HEADER_Y - 25
+CONTINUED_TABLE_HEADER_Y = TOP - 25
+CONTINUED_ROWS_TOP = CONTINUED_TABLE_HEADER_Y - 25
+
+ROW_GAP = 20
+DESC_LINE_HEIGHT = 12
+ICD_LINE_HEIGHT = 15
+
+
+@lru_cache(maxsize=65536)
+def text_width(text, font):
+    """Measure text in points for one of the FONTS"""
+    from reportlab.pdfbase.pdfmetrics import stringWidth
+    font_name, font_size = FONTS[font]
+    return stringWidth(text, font_name, font_size)
+
+
+@lru_cache(maxsize=16384)
+def wrap_text(text, font, max_width, separator=' '):
+    """Break text into lines no wider than max_width, only between words
+
+    Standard-font widths are additive, so each line is measured from its
+    cached word widths instead of re-measuring the growing line.
+    """
+    if text_width(text, font) <= max_width:
+        return (text,)
+    words = text.split() if separator == ' ' else text.split(separator)
+    separator_width = text_width(separator, font)
+    lines = []
+    current = []
+    current_width = 0.0
+    for word in words:
+        word_width = text_width(word, font)
+        if current and current_width + separator_width + word_width > max_width:
+            lines.append(separator.join(current))
+            current = [word]
+            current_width = word_width
+        else:
+            current_width += (separator_width if current else 0) + word_width
+            current.append(word)
+    if current:
+        lines.append(separator.join(current))
+    return tuple(lines) or ('',)
+
+
+def _table_header_ops(y):
+    ops = [('text', 'table_header', x, y, header) for x, header in zip(COL_POSITIONS, TABLE_HEADERS)]
+    ops.append(('line', 0.5, MARGIN_LEFT, y - 15, PAGE_WIDTH - MARGIN_RIGHT))
+    return ops
+
+
+# Content that is identical on every bill, planned once and copied into each
+# page that uses it. Inline drawing beats form XObjects here: a bill is
+# usually a single page, where a form only adds its object and resources.
+TEMPLATES = {
+    'first_page': (
+        ('centred', 'title', PAGE_WIDTH / 2, TITLE_Y, "PATIENT BILLING STATEMENT"),
+        ('text', 'section', MARGIN_LEFT, PATIENT_HEADING_Y, "PATIENT INFORMATION"),
+        ('text', 'section', MARGIN_LEFT, PROVIDER_HEADING_Y, "PROVIDER INFORMATION"),
+        ('text', 'section', MARGIN_LEFT, SERVICES_HEADING_Y, "SERVICES & CHARGES"),
+        *_table_header_ops(TABLE_HEADER_Y),
+    ),
+    'continued_page': (
+        ('text', 'section', MARGIN_LEFT, TOP, "SERVICES & CHARGES (CONTINUED)"),
+        *_table_header_ops(CONTINUED_TABLE_HEADER_Y),
+    ),
+}
+
+
+def plan_bill(rows, provider, location, service_date_icds, generated_at):
+    """Lay out a whole bill in one pass and return its pages
+
+    Each page is a list of drawing operations: ('text' | 'centred' | 'right',
+    font, x, y, string) or ('line', line_width, x1, y, x2).
+    """
+    pages = []
+    ops = None
+    y = TOP
+
+    def new_page(template=None, top=TOP):
+        nonlocal ops, y
+        ops = []
+        pages.append(ops)
+        y = top
+        if template:
+            ops.extend(TEMPLATES[template])
+
+    def text(font, x, string):
+        ops.append(('text', font, x, y, string))
+
+    def draw_first_page():
+        nonlocal y
+        new_page('first_page', ROWS_TOP)
+        patient = rows[0]  # Use first row for patient info
+        name = patient.get('patient_name', 'N/A')
+        pid = patient.get('patient_id', 'N/A')
+        address_parts = [
+            patient.get('patient_address1', '').strip(),
+            patient.get('patient_city', '').strip(),
+            patient.get('patient_state', '').strip(),
+            patient.get('patient_zip', '').strip()
+        ]
+        address = ", ".join(filter(None, address_parts))
+
+        ops.append(('text', 'normal', MARGIN_LEFT, NAME_Y, f"Name: {name}    Patient ID: #{pid}"))
+        ops.append(('text', 'normal', MARGIN_LEFT, ADDRESS_Y, f"Address: {address}"))
+        ops.append(('text', 'normal', MARGIN_LEFT, PROVIDER_Y, f"Provider: {provider}"))
+        ops.append(('text', 'normal', MARGIN_LEFT, LOCATION_Y, f"Location: {location}"))
+
+    def continue_table():
+        new_page('continued_page', CONTINUED_ROWS_TOP)
+
+    def draw_services_table():
+        nonlocal y
+        rows_top = y
+        total = 0.0
+        for i, row in enumerate(rows, 1):
+            desc = str(row.get('code_desc', '') or '').strip().upper()
+            try:
+                cost = float(row.get('Charges') or 0)
+            except (ValueError, TypeError):
+                cost = 0.0
+            total += cost
+            desc_lines = wrap_text(desc, 'small', DESC_WIDTH)
+
+            # Keep a row's wrapped description on one page, unless it could never fit
+            desc_height = DESC_LINE_HEIGHT * (len(desc_lines) - 1)
+            fits_on_page = CONTINUED_ROWS_TOP - desc_height >= BOTTOM
+            if y < rows_top and (y < BOTTOM or (y - desc_height < BOTTOM and fits_on_page)):
+                continue_table()
+                rows_top = y
+
+            values = (
+                str(i),
+                str(row.get('date_of_service') or ''),
+                str(row.get('code') or ''),
+                desc_lines[0],
+                str(row.get('code_modifier_1') or ''),
+                str(row.get('ChargeUnits') or '1'),
+                f"${cost:,.2f}",
+            )
+            for x, value in zip(COL_POSITIONS, values):
+                text('small', x, value)
+            for desc_line in desc_lines[1:]:
+                y -= DESC_LINE_HEIGHT
+                # A description longer than a page carries on below the repeated table header
+                if y < BOTTOM:
+                    continue_table()
+                    rows_top = y
+                text('small', COL_POSITIONS[3], desc_line)
+            y -= ROW_GAP
+
+        y -= 5
+        if y < BOTTOM:
+            continue_table()
+        text('table_header', COL_POSITIONS[-2], "TOTAL:")
+        text('table_header', COL_POSITIONS[-1], f"${total:,.2f}")
+        y -= 30
+
+    def draw_icd_section():
+        nonlocal y
+        all_icds = []
+        for icds in service_date_icds.values():
+            all_icds.extend(icds)
+        # Remove duplicates while preserving order
+        unique_icds = list(dict.fromkeys(all_icds))
+        icd_text = ', '.join(unique_icds) if unique_icds else "N/A"
+
+        # The heading moves to the next page with at least its first line
+        if y - 20 < BOTTOM:
+            new_page()
+        text('section', MARGIN_LEFT, "DIAGNOSIS CODES (ICD):")
+        y -= 20
+        for line in wrap_text(icd_text, 'small', ICD_WIDTH, ', '):
+            if y < BOTTOM:
+                new_page()
+            text('small', MARGIN_LEFT, line)
+            y -= ICD_LINE_HEIGHT
+        y -= 10
+
+    draw_first_page()
+    draw_services_table()
+    draw_icd_section()
+
+    timestamp = generated_at.strftime("%B %d, %Y at %I:%M %p")
+    for number, page_ops in enumerate(pages, 1):
+        page_ops.append(('text', 'footer', MARGIN_LEFT, FOOTER_Y, f"Generated on {timestamp}"))
+        page_ops.append(('right', 'footer', PAGE_WIDTH - MARGIN_RIGHT, FOOTER_Y,
+                         f"Page {number} of {len(pages)}"))
+    return pages
@@ -0,0 +1,128 @@
+import io
+import os
+import json
+import time
+import zipfile
+
+# Compression policy: 'stored', 'deflate', 'deflate:<level>' or 'auto'. Auto deflates
+# the first entry and switches to stored when it saved less than AUTO_MIN_SAVING.
+ZIP_COMPRESSION = os.environ.get('ZIP_COMPRESSION', 'deflate:6')
+AUTO_MIN_SAVING = float(os.environ.get('ZIP_AUTO_MIN_SAVING', 0.05))
+DEFAULT_DEFLATE_LEVEL = 6
+# Cached ZIPs start with this line and their stats as JSON, so hits report them too
+CACHE_MAGIC = b'PBGZIP1\n'
+# Disk cache suffix for those entries, which are not valid ZIP files on their own
+CACHE_SUFFIX = '.pbgzip'
+
+
+def parse_compression(spec):
+    """Parse a compression policy into (mode, deflate level)"""
+    mode, _, level = spec.strip().lower().partition(':')
+    if mode not in ('stored', 'deflate', 'auto'):
+        raise ValueError(f"Unknown ZIP compression policy: {spec}")
+    level = int(level) if level else DEFAULT_DEFLATE_LEVEL
+    if not 0 <= level <= 9:
+        raise ValueError(f"Deflate level must be between 0 and 9: {spec}")
+    return mode, level
+
+
+def new_stats():
+    """Counters filled in while a ZIP is written"""
+    return {'entries': 0, 'raw_bytes': 0, 'compressed_bytes': 0,
+            'saved_bytes': 0, 'compress_seconds': 0.0, 'compression': None}
+
+
+def stats_headers(stats):
+    """Response headers describing how a ZIP was compressed"""
+    return [
+        ('X-Zip-Compression', stats['compression']),
+        ('X-Zip-Bytes-Saved', str(stats['saved_bytes'])),
+        ('X-Zip-Compression-Ms', f"{stats['compress_seconds'] * 1000:.1f}"),
+    ]
+
+
+def pack_cached(zip_bytes, stats):
+    """Prefix a ZIP with its stats for the bill cache"""
+    return CACHE_MAGIC + json.dumps(stats).encode('utf-8') + b'\n' + zip_bytes
+
+
+def unpack_cached(data):
+    """Split a bill cache entry back into (zip_bytes, stats); stats is None if unknown"""
+    if not data.startswith(CACHE_MAGIC):
+        return data, None
+    end = data.index(b'\n', len(CACHE_MAGIC))
+    return data[end + 1:], json.loads(data[len(CACHE_MAGIC):end])
+
+
+class _ChunkSink(io.RawIOBase):
+    """Unseekable write target that hands written bytes back in chunks.
+
+    Because it cannot seek, zipfile writes each entry with a data descriptor
+    after its data instead of patching sizes into the local header.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self._chunks = []
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def drain(self):
+        data = b''.join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+class _EntryWriter:
+    """Write entries under a compression policy and record what it saved"""
+
+    def __init__(self, zf, policy, stats):
+        self.zf = zf
+        self.mode, self.level = parse_compression(policy or ZIP_COMPRESSION)
+        self.stats = stats if stats is not None else new_stats()
+        self.stats['compression'] = 'stored' if self.mode == 'stored' else f"deflate:{self.level}"
+
+    def write(self, filename, data):
+        compress_type = zipfile.ZIP_STORED if self.mode == 'stored' else zipfile.ZIP_DEFLATED
+        started = time.perf_counter()
+        self.zf.writestr(filename, data, compress_type=compress_type, compresslevel=self.level)
+        self.stats['compress_seconds'] += time.perf_counter() - started
+
+        info = self.zf.infolist()[-1]
+        self.stats['entries'] += 1
+        self.stats['raw_bytes'] += info.file_size
+        self.stats['compressed_bytes'] += info.compress_size
+        self.stats['saved_bytes'] += info.file_size - info.compress_size
+
+        if self.mode == 'auto':
+            # Decide once, from the first entry: PDFs are usually compressed already
+            saving = 1 - info.compress_size / info.file_size if info.file_size else 0
+            self.mode = 'deflate' if saving >= AUTO_MIN_SAVING else 'stored'
+            self.stats['compression'] = 'auto:' + ('stored' if self.mode == 'stored' else f"deflate:{self.level}")
+
+
+def build_zip(files, policy=None, stats=None):
+    """Build a ZIP archive in memory from (filename, data) pairs"""
+    zip_buffer = io.BytesIO()
+    with zipfile.ZipFile(zip_buffer, 'w') as zf:
+        writer = _EntryWriter(zf, policy, stats)
+        for filename, data in files:
+            writer.write(filename, data)
+    return zip_buffer.getvalue()
+
+
+def stream_zip(files, policy=None, stats=None):
+    """Yield a ZIP archive chunk by chunk as each (filename, data) pair arrives"""
+    sink = _ChunkSink()
+    with zipfile.ZipFile(sink, 'w') as zf:
+        writer = _EntryWriter(zf, policy, stats)
+        for filename, data in files:
+            writer.write(filename, data)
+            yield sink.drain()
+    # Central directory
+    yield sink.drain()
@@ -0,0 +1,70 @@
+import threading
+
+_types_lock = threading.Lock()
+_row_types = {}
+
+
+class ClaimRow(tuple):
+    """One claim line, stored as the tuple of its column values.
+
+    Each header layout gets its own subclass whose column positions are worked
+    out once, so rows carry no per-row dict. Rows keep the read-only dict API
+    the bill code uses (get, [name], keys, items) and serialise as JSON arrays.
+    """
+
+    __slots__ = ()
+    headers = ()
+    _index = {}
+
+    def get(self, name, default=None):
+        """Return a column value by name, like dict.get"""
+        position = self._index.get(name)
+        return default if position is None else tuple.__getitem__(self, position)
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            return tuple.__getitem__(self, self._index[key])
+        return tuple.__getitem__(self, key)
+
+    def __contains__(self, name):
+        return name in self._index
+
+    def keys(self):
+        return self._index.keys()
+
+    def items(self):
+        return [(name, tuple.__getitem__(self, position)) for name, position in self._index.items()]
+
+    def to_dict(self):
+        """Return the row as the dict(zip(headers, cols)) it replaces"""
+        return dict(self.items())
+
+    def __reduce__(self):
+        # Subclasses are built at runtime, so pickle rows by header layout
+        return _rebuild_row, (self.headers, tuple(self))
+
+    def __repr__(self):
+        return f"ClaimRow({self.to_dict()!r})"
+
+
+def claim_row_type(headers):
+    """Return the ClaimRow subclass for a header layout, creating it once"""
+    headers = tuple(headers)
+    row_type = _row_types.get(headers)
+    if row_type is None:
+        with _types_lock:
+            row_type = _row_types.get(headers)
+            if row_type is None:
+                # Later duplicate headers win, as they did with dict(zip(headers, cols))
+                index = {name: position for position, name in enumerate(headers)}
+                row_type = type('ClaimRow', (ClaimRow,), {
+                    '__slots__': (),
+                    'headers': headers,
+                    '_index': index,
+                })
+                _row_types[headers] = row_type
+    return row_type
+
+
+def _rebuild_row(headers, values):
+    return claim_row_type(headers)(values)
@@ -0,0 +1,115 @@
+import os
+import sys
+import argparse
+import time
+
+import app
+import bill_export
+import bill_zip
+import data_index
+import columnar_store
+import patient_catalog
+
+
+def build_index_command(args):
+    """Build the patient_id index and patient catalog, only scanning appended data when possible"""
+    started = time.perf_counter()
+    # Waits for any server process building either file, then builds under the same locks
+    index, _ = patient_catalog.update_index_and_catalog(args.data, args.index, args.catalog,
+                                                        workers=args.workers, full=args.full)
+    print(f"Indexed {index.meta['entries']} rows for {index.meta['keys']} patients and cataloged them "
+          f"in {time.perf_counter() - started:.1f}s -> {args.index}, {args.catalog}")
+
+
+def build_store_command(args):
+    """Convert the data file into the patient-sorted columnar store"""
+    started = time.perf_counter()
+    index = data_index.get_index(args.data, args.index)
+    with data_index.BuildLock(args.store):
+        store = columnar_store.build_store(args.data, args.store, index)
+    print(f"Stored {store.meta['rows']} rows in {len(store.meta['columns'])} columns "
+          f"in {time.perf_counter() - started:.1f}s -> {args.store}")
+
+
+def batch_command(args):
+    """Generate bills for a list of patient IDs into a ZIP file or a directory tree"""
+    started = time.perf_counter()
+    if args.ids == '-':
+        patient_ids = app.parse_patient_ids(sys.stdin.read().splitlines())
+    else:
+        with open(args.ids, encoding='utf-8') as f:
+            patient_ids = app.parse_patient_ids(f.read().splitlines())
+    patient_rows = app.search_many_rows(patient_ids)
+    files = app.batch_files(patient_rows, args.layout)
+
+    if args.out.lower().endswith('.zip'):
+        tmp_path = f"{args.out}.tmp{os.getpid()}"
+        with open(tmp_path, 'wb') as out:
+            for chunk in bill_zip.stream_zip(files):
+                out.write(chunk)
+        os.replace(tmp_path, args.out)
+    else:
+        for arcname, data in files:
+            path = os.path.join(args.out, *arcname.split('/'))
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'wb') as out:
+                out.write(data)
+
+    missing = sum(1 for rows in patient_rows.values() if not rows)
+    print(f"Generated bills for {len(patient_rows) - missing} patients ({missing} not found) "
+          f"in {time.perf_counter() - started:.1f}s -> {args.out}")
+
+
+def export_command(args):
+    """Write every patient's bills to a directory tree, resuming an interrupted export"""
+    started = time.perf_counter()
+    try:
+        state = bill_export.export_bills(args.data, args.out, workers=args.workers, memory_mb=args.memory_mb,
+                                         tmp_dir=args.tmp_dir, restart=args.restart)
+    except KeyboardInterrupt:
+        print("Export interrupted; progress is saved, run the same command to resume")
+        sys.exit(130)
+    print(f"Exported {state['bills']} bills for {state['patients']} patients "
+          f"({state['bytes'] / 1024 ** 2:.0f} MB) in {time.perf_counter() - started:.1f}s -> {args.out}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Patient Bill Generator data tools")
+    parser.add_argument('--data', default=app.FILE_PATH, help="Pipe-delimited data file")
+    parser.add_argument('--index', default=None, help="Patient index file (default: <data>.idx)")
+    parser.add_argument('--store', default=None, help="Columnar store file (default: <data>.col)")
+    parser.add_argument('--catalog', default=None, help="Patient catalog file (default: <data>.catalog)")
+    parser.add_argument('--workers', type=int, default=None,
+                        help="Processes used to build the index (default: INDEX_WORKERS or CPU count) "
+                             "or to render an export (default: RENDER_WORKERS)")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    build_index = commands.add_parser('build-index', help="Build or update the patient_id index and patient catalog")
+    build_index.add_argument('--full', action='store_true', help="Rebuild from scratch even after appends")
+    build_index.set_defaults(func=build_index_command)
+    commands.add_parser('build-store', help="Build the columnar store").set_defaults(
+        func=build_store_command)
+
+    batch = commands.add_parser('batch', help="Generate bills for many patient IDs")
+    batch.add_argument('ids', help="File with one patient ID per line, or - for stdin")
+    batch.add_argument('out', help="Output .zip file, or a directory for a per-patient tree")
+    batch.add_argument('--layout', choices=('tree', 'nested'), default='tree',
+                       help="One directory per patient, or one ZIP per patient")
+    batch.set_defaults(func=batch_command)
+
+    export = commands.add_parser('export', help="Write every patient's bills to a directory tree")
+    export.add_argument('out', help="Output directory; holds one directory of PDFs per patient")
+    export.add_argument('--memory-mb', type=int, default=256,
+                        help="Rows buffered while grouping before sorted runs spill to disk")
+    export.add_argument('--tmp-dir', default=None, help="Directory for spilled runs (default: the output directory)")
+    export.add_argument('--restart', action='store_true', help="Ignore the checkpoint and export everything")
+    export.set_defaults(func=export_command)
+
+    args = parser.parse_args(argv)
+    app.configure_data_paths(args.data, args.index, args.store, args.catalog)
+    args.index, args.store, args.catalog = app.INDEX_PATH, app.STORE_PATH, app.CATALOG_PATH
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
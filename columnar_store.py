@@ -0,0 +1,394 @@
+import os
+import sys
+import json
+import mmap
+import bisect
+import shutil
+import struct
+import hashlib
+import tempfile
+import threading
+from array import array
+
+import data_index
+import record_reader
+import metrics
+from claim_row import claim_row_type
+
+# Columnar layout: magic, meta length, JSON meta, then 8-byte aligned sections.
+# Rows are sorted by lowercased patient_id (file order within a patient). Every
+# column is either dictionary-encoded (distinct values + one uint32 code per row)
+# or plain (uint64 end offsets + concatenated UTF-8 values).
+STORE_MAGIC = b'PBGCOL01'
+STORE_VERSION = 1
+DICT_MAX_VALUES = 1 << 16  # columns with more distinct values are stored plain
+_META_LEN = struct.Struct('<I')
+_VALUE_LEN = struct.Struct('<I')
+_ALIGN = 8
+
+_store_lock = threading.Lock()
+_loaded_store = None
+# data_path -> (signature, sha256) checked off the request path by a background build,
+# cached from the <store>.verified file so one re-hash covers every worker
+_verified_signatures = {}
+
+
+def default_store_path(data_path):
+    """Get the path of the columnar store that belongs to a data file"""
+    return os.environ.get('STORE_PATH') or f"{data_path}.col"
+
+
+def verified_path(store_path):
+    """Get the file recording a data file signature whose content was hashed and matched the store"""
+    return f"{store_path}.verified"
+
+
+def _read_verification(store_path):
+    try:
+        with open(verified_path(store_path), encoding='utf-8') as f:
+            saved = json.load(f)
+        return (saved['size'], saved['mtime_ns']), saved['sha256']
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
+
+
+def _record_verification(store_path, signature, sha256):
+    tmp_path = data_index.builder_tmp_path(verified_path(store_path))
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump({'size': signature[0], 'mtime_ns': signature[1], 'sha256': sha256}, f)
+    os.replace(tmp_path, verified_path(store_path))
+
+
+def file_sha256(path, chunk_size=8 * 1024 * 1024):
+    """Hash a file in chunks"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class _SectionWriter:
+    """Append aligned sections to the store body and remember where they landed"""
+
+    def __init__(self, f):
+        self.f = f
+        self.pos = 0
+
+    def write(self, data):
+        start = self.pos
+        self.f.write(data)
+        self.pos += len(data)
+        padding = -self.pos % _ALIGN
+        if padding:
+            self.f.write(bytes(padding))
+            self.pos += padding
+        return [start, len(data)]
+
+
+def _iter_values(f):
+    """Read back length-prefixed values spilled during the build"""
+    f.seek(0)
+    read = f.read
+    while True:
+        head = read(_VALUE_LEN.size)
+        if not head:
+            return
+        (length,) = _VALUE_LEN.unpack(head)
+        yield read(length)
+
+
+def build_store(data_path, store_path, index=None):
+    """Convert the data file into a patient-sorted columnar store"""
+    index = index or data_index.get_index(data_path)
+    reader = record_reader.get_reader(data_path)
+    headers = index.headers
+    size, mtime_ns = data_index.data_file_signature(data_path)
+    source = {'size': size, 'mtime_ns': mtime_ns, 'sha256': file_sha256(data_path)}
+
+    store_dir = os.path.dirname(os.path.abspath(store_path))
+    with tempfile.TemporaryDirectory(dir=store_dir) as tmp:
+        # Spill every column to its own file so memory stays bounded by the dictionaries
+        spills = [open(os.path.join(tmp, f"col{i}"), 'w+b') for i in range(len(headers))]
+        dictionaries = [{} for _ in headers]
+        key_blob = bytearray()
+        key_ends = array('Q')
+        row_ends = array('Q')
+        rows = 0
+        for key in index.keys():
+            for offset, length in index.locate(key):
+                for i, value in enumerate(reader.record_columns(offset, length)):
+                    encoded = value.encode('utf-8')
+                    spills[i].write(_VALUE_LEN.pack(len(encoded)))
+                    spills[i].write(encoded)
+                    dictionary = dictionaries[i]
+                    if dictionary is not None and encoded not in dictionary:
+                        if len(dictionary) >= DICT_MAX_VALUES:
+                            dictionaries[i] = None
+                        else:
+                            dictionary[encoded] = len(dictionary)
+                rows += 1
+            key_blob += key.encode('utf-8')
+            key_ends.append(len(key_blob))
+            row_ends.append(rows)
+
+        body_path = os.path.join(tmp, 'body')
+        with open(body_path, 'wb') as body:
+            sections = _SectionWriter(body)
+            keys_meta = {
+                'count': len(key_ends),
+                'blob': sections.write(key_blob),
+                'ends': sections.write(key_ends.tobytes()),
+                'row_ends': sections.write(row_ends.tobytes()),
+            }
+            columns_meta = []
+            for name, spill, dictionary in zip(headers, spills, dictionaries):
+                if dictionary is not None:
+                    codes = array('I', (dictionary[value] for value in _iter_values(spill)))
+                    values_ends = array('Q')
+                    values_blob = bytearray()
+                    for value in dictionary:
+                        values_blob += value
+                        values_ends.append(len(values_blob))
+                    columns_meta.append({
+                        'name': name,
+                        'encoding': 'dict',
+                        'values': sections.write(values_blob),
+                        'value_ends': sections.write(values_ends.tobytes()),
+                        'codes': sections.write(codes.tobytes()),
+                    })
+                else:
+                    blob_start = sections.pos
+                    ends = array('Q')
+                    total = 0
+                    for value in _iter_values(spill):
+                        body.write(value)
+                        total += len(value)
+                        ends.append(total)
+                    sections.pos += total
+                    padding = -sections.pos % _ALIGN
+                    body.write(bytes(padding))
+                    sections.pos += padding
+                    columns_meta.append({
+                        'name': name,
+                        'encoding': 'plain',
+                        'blob': [blob_start, total],
+                        'ends': sections.write(ends.tobytes()),
+                    })
+                spill.close()
+
+        meta = {
+            'version': STORE_VERSION,
+            'byteorder': sys.byteorder,
+            'headers': headers,
+            'rows': rows,
+            'source': source,
+            'keys': keys_meta,
+            'columns': columns_meta,
+        }
+        meta_bytes = json.dumps(meta).encode('utf-8')
+        head_size = len(STORE_MAGIC) + _META_LEN.size + len(meta_bytes)
+        tmp_path = data_index.builder_tmp_path(store_path)
+        with open(tmp_path, 'wb') as out, open(body_path, 'rb') as body:
+            out.write(STORE_MAGIC)
+            out.write(_META_LEN.pack(len(meta_bytes)))
+            out.write(meta_bytes)
+            out.write(bytes(-head_size % _ALIGN))
+            shutil.copyfileobj(body, out)
+        os.replace(tmp_path, store_path)
+    return ColumnarStore(store_path)
+
+
+class _Column:
+    """Random access to one stored column"""
+
+    def __init__(self, view, meta):
+        self.encoding = meta['encoding']
+        if self.encoding == 'dict':
+            self._values = _section(view, meta['values'])
+            self._value_ends = _section(view, meta['value_ends']).cast('Q')
+            self._codes = _section(view, meta['codes']).cast('I')
+            self._decoded = {}
+        else:
+            self._blob = _section(view, meta['blob'])
+            self._ends = _section(view, meta['ends']).cast('Q')
+
+    def value(self, row):
+        if self.encoding == 'dict':
+            code = self._codes[row]
+            value = self._decoded.get(code)
+            if value is None:
+                start = self._value_ends[code - 1] if code else 0
+                value = self._decoded[code] = str(self._values[start:self._value_ends[code]], 'utf-8')
+            return value
+        start = self._ends[row - 1] if row else 0
+        return str(self._blob[start:self._ends[row]], 'utf-8')
+
+    def release(self):
+        for view in vars(self).values():
+            if isinstance(view, memoryview):
+                view.release()
+
+
+def _section(view, location):
+    start, length = location
+    return view[start:start + length]
+
+
+class _SortedKeys:
+    """Sequence view over the stored patient keys, for bisect"""
+
+    def __init__(self, blob, ends):
+        self._blob = blob
+        self._ends = ends
+
+    def __len__(self):
+        return len(self._ends)
+
+    def __getitem__(self, i):
+        start = self._ends[i - 1] if i else 0
+        return str(self._blob[start:self._ends[i]], 'utf-8')
+
+
+class ColumnarStore:
+    """Memory-mapped, read-only columnar store"""
+
+    def __init__(self, store_path):
+        self.store_path = store_path
+        self._file = open(store_path, 'rb')
+        st = os.fstat(self._file.fileno())
+        self.file_id = (st.st_ino, st.st_mtime_ns, st.st_size)
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._map[:len(STORE_MAGIC)] != STORE_MAGIC:
+            self.close()
+            raise ValueError(f"Not a columnar store: {store_path}")
+        pos = len(STORE_MAGIC)
+        (meta_len,) = _META_LEN.unpack_from(self._map, pos)
+        pos += _META_LEN.size
+        self.meta = json.loads(self._map[pos:pos + meta_len])
+        if self.meta.get('version') != STORE_VERSION or self.meta.get('byteorder') != sys.byteorder:
+            self.close()
+            raise ValueError(f"Incompatible columnar store: {store_path}")
+        pos += meta_len
+        body_start = pos + (-pos % _ALIGN)
+
+        self.headers = self.meta['headers']
+        self._view = memoryview(self._map)[body_start:]
+        keys = self.meta['keys']
+        self._key_blob = _section(self._view, keys['blob'])
+        self._key_ends = _section(self._view, keys['ends']).cast('Q')
+        self._row_ends = _section(self._view, keys['row_ends']).cast('Q')
+        self._keys = _SortedKeys(self._key_blob, self._key_ends)
+        self._columns = [_Column(self._view, column) for column in self.meta['columns']]
+
+    def close(self):
+        """Release every view into the mapping, then the mapping itself"""
+        for column in getattr(self, '_columns', []):
+            column.release()
+        for name in ('_key_blob', '_key_ends', '_row_ends', '_view'):
+            view = getattr(self, name, None)
+            if view is not None:
+                view.release()
+        self._map.close()
+        self._file.close()
+
+    def is_current(self):
+        """Check whether this is still the newest store file on disk"""
+        try:
+            st = os.stat(self.store_path)
+        except OSError:
+            return False
+        return (st.st_ino, st.st_mtime_ns, st.st_size) == self.file_id
+
+    def is_fresh(self, data_path):
+        """Check the data file against the recorded source without reading it
+
+        A changed mtime only counts as fresh once a background build, in any
+        process, has hashed the file and found the recorded content (see
+        _build_generation).
+        """
+        source = self.meta['source']
+        signature = data_index.data_file_signature(data_path)
+        if signature == (source['size'], source['mtime_ns']):
+            return True
+        verified = _verified_signatures.get(data_path)
+        if verified is None or verified[0] != signature:
+            verified = _read_verification(self.store_path)
+            if verified is None:
+                return False
+            _verified_signatures[data_path] = verified
+        return verified == (signature, source['sha256'])
+
+    def read_rows(self, patient_id):
+        """Binary search the sorted keys and read the patient's row slice"""
+        key = patient_id.lower()
+        i = bisect.bisect_left(self._keys, key)
+        if i == len(self._keys) or self._keys[i] != key:
+            return []
+        start = self._row_ends[i - 1] if i else 0
+        columns = self._columns
+        row_type = claim_row_type(self.headers)
+        metrics.inc('rows_scanned', self._row_ends[i] - start)
+        return [row_type([column.value(row) for column in columns])
+                for row in range(start, self._row_ends[i])]
+
+
+def _attach_store(store_path):
+    """Return the newest store generation on disk, fresh or not, or None"""
+    global _loaded_store
+    store = _loaded_store
+    if store is None or store.store_path != store_path or not store.is_current():
+        try:
+            store = ColumnarStore(store_path)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            print(f"Warning: Ignoring unreadable columnar store {store_path}: {e}")
+            return None
+        # The previous generation is released once in-flight reads drop it
+        _loaded_store = store
+    return store
+
+
+def _build_generation(data_path, store_path):
+    """Revalidate or rebuild a stale store unless another process already is"""
+    with data_index.BuildLock(store_path, blocking=False) as acquired:
+        if not acquired:
+            return False
+        with _store_lock:
+            store = _attach_store(store_path)
+        if store is not None and store.is_fresh(data_path):
+            return True
+        signature = data_index.data_file_signature(data_path)
+        if store is not None and signature[0] == store.meta['source']['size'] \
+                and file_sha256(data_path) == store.meta['source']['sha256']:
+            # Only the modification time changed; recorded for the other workers too
+            _record_verification(store_path, signature, store.meta['source']['sha256'])
+            _verified_signatures[data_path] = (signature, store.meta['source']['sha256'])
+            return True
+        print(f"Rebuilding stale columnar store {store_path}...")
+        build_store(data_path, store_path)
+        return True
+
+
+_background = data_index.BackgroundBuild('store', 'columnar store', _build_generation, _store_lock)
+
+
+def get_store(data_path, store_path=None):
+    """Return the columnar store for data_path, or None when there is no fresh one.
+
+    The store is only created by `cli.py build-store`. Once it exists, a store
+    that no longer matches the data file is revalidated or rebuilt on a
+    background thread and None is returned meanwhile, so callers fall back to
+    the patient index.
+    """
+    store_path = store_path or default_store_path(data_path)
+    with _store_lock:
+        store = _attach_store(store_path)
+    if store is not None and store.is_fresh(data_path):
+        return store
+    if store is None and not os.path.exists(store_path):
+        return None
+
+    _background.start(data_path, store_path)
+    return None
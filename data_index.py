@@ -0,0 +1,631 @@
+import os
+import json
+import mmap
+import hashlib
+import struct
+import threading
+import time
+from array import array
+from concurrent.futures import as_completed
+
+try:
+    import fcntl
+except ImportError:  # Windows: builds are only coordinated within this process
+    fcntl = None
+
+# On-disk layout: magic, meta length, JSON meta, key blob, key table, entry table.
+# Keys are sorted lowercased patient IDs; each one points at a contiguous run of
+# (byte offset, byte length) entries into the data file.
+INDEX_MAGIC = b'PBGIDX01'
+INDEX_VERSION = 1
+_META_LEN = struct.Struct('<I')
+_KEY_RECORD = struct.Struct('<QIQI')  # key blob offset, key length, first entry, entry count
+_ENTRY = struct.Struct('<QI')  # record offset, record length
+
+# Parallel build tuning: files smaller than one shard are indexed in-process
+MIN_SHARD_BYTES = 32 * 1024 * 1024
+SHARDS_PER_WORKER = 4
+# Bytes before the resume point that must be unchanged for an append-only update
+TAIL_CHECK_BYTES = 64 * 1024
+# How long to wait before retrying a background build another process is running
+BUILD_RETRY_SECONDS = 5
+
+_index_lock = threading.Lock()
+# Per lock file, for platforms without flock; one lock per file so builds can nest
+_local_build_locks = {}
+_loaded_index = None
+
+
+def default_index_path(data_path):
+    """Get the path of the index file that belongs to a data file"""
+    return os.environ.get('INDEX_PATH') or f"{data_path}.idx"
+
+
+def builder_tmp_path(path):
+    """Get a temporary path next to path that no other builder process or thread uses"""
+    return f"{path}.tmp{os.getpid()}-{threading.get_ident()}"
+
+
+def data_file_signature(data_path):
+    """Return the (size, mtime_ns) pair used to detect data file changes"""
+    st = os.stat(data_path)
+    return st.st_size, st.st_mtime_ns
+
+
+def split_record_terminator(raw):
+    """Split a binary line into its body and trailing newline bytes"""
+    if raw.endswith(b'\r\n'):
+        return raw[:-2], 2
+    if raw.endswith(b'\n') or raw.endswith(b'\r'):
+        return raw[:-1], 1
+    return raw, 0
+
+
+def iter_records(f, start, end=None):
+    """Yield (offset, body) for every logical line between start and end.
+
+    Lines are split the same way text-mode universal newlines split them
+    (\\n, \\r\\n and a lone \\r) so offsets line up with what search_rows() sees.
+    """
+    f.seek(start)
+    offset = start
+    for raw in f:
+        if end is not None and offset >= end:
+            break
+        body, _ = split_record_terminator(raw)
+        if b'\r' in body:
+            # Lone carriage returns are line breaks in text mode too
+            part_offset = offset
+            for part in body.split(b'\r'):
+                yield part_offset, part
+                part_offset += len(part) + 1
+        else:
+            yield offset, body
+        offset += len(raw)
+
+
+def read_header(f):
+    """Read the header columns and return them with the offset of the first data line"""
+    f.seek(0)
+    raw = f.readline()
+    body, _ = split_record_terminator(raw)
+    if b'\r' in body:
+        # Header ended on a lone \r; data starts right after it
+        body = body.split(b'\r', 1)[0]
+        data_start = len(body) + 1
+    else:
+        data_start = len(raw)
+    headers = body.decode('utf-8').strip().split('|')
+    return headers, data_start
+
+
+def patient_column(headers):
+    """Get the column position dict(zip(headers, cols)) reads patient_id from"""
+    return {name: i for i, name in enumerate(headers)}.get('patient_id')
+
+
+def parse_record(body, headers):
+    """Decode and split one record, returning None for lines search_rows() skips"""
+    try:
+        cols = body.decode('utf-8').strip().split('|')
+    except UnicodeDecodeError:
+        return None
+    if len(cols) != len(headers):
+        return None
+    return cols
+
+
+def scan_range(data_path, headers, start, end=None, collector=None):
+    """Collect patient keys and record locations for one byte range of the data file
+
+    A collector, when given, is also handed the columns of every record, so
+    other per-record tables can be built in the same pass.
+    """
+    pid_col = patient_column(headers)
+    key_ids = {}
+    entry_keys = array('I')
+    offsets = array('Q')
+    lengths = array('I')
+    with open(data_path, 'rb') as f:
+        for offset, body in iter_records(f, start, end):
+            cols = parse_record(body, headers)
+            if cols is None:
+                continue
+            if collector is not None:
+                collector.add(cols)
+            key = cols[pid_col].lower() if pid_col is not None else ''
+            key_id = key_ids.get(key)
+            if key_id is None:
+                key_id = key_ids[key] = len(key_ids)
+            entry_keys.append(key_id)
+            offsets.append(offset)
+            lengths.append(len(body))
+    return list(key_ids), entry_keys, offsets, lengths
+
+
+def write_index(index_path, meta, keys, entry_keys, offsets, lengths):
+    """Write a sorted index file atomically"""
+    order = sorted(range(len(keys)), key=keys.__getitem__)
+    counts = [0] * len(keys)
+    for key_id in entry_keys:
+        counts[key_id] += 1
+
+    # Counting sort: entries for each key end up contiguous, still in file order
+    starts = [0] * len(keys)
+    position = 0
+    for key_id in order:
+        starts[key_id] = position
+        position += counts[key_id]
+    slots = array('Q', bytes(8 * len(entry_keys)))
+    cursor = list(starts)
+    for i, key_id in enumerate(entry_keys):
+        slots[cursor[key_id]] = i
+        cursor[key_id] += 1
+
+    blob = bytearray()
+    key_table = bytearray()
+    for key_id in order:
+        encoded = keys[key_id].encode('utf-8')
+        key_table += _KEY_RECORD.pack(len(blob), len(encoded), starts[key_id], counts[key_id])
+        blob += encoded
+    entry_table = bytearray()
+    for i in slots:
+        entry_table += _ENTRY.pack(offsets[i], lengths[i])
+
+    meta = dict(meta, version=INDEX_VERSION, keys=len(keys), entries=len(entry_keys),
+                blob_size=len(blob))
+    meta_bytes = json.dumps(meta).encode('utf-8')
+
+    tmp_path = builder_tmp_path(index_path)
+    with open(tmp_path, 'wb') as out:
+        out.write(INDEX_MAGIC)
+        out.write(_META_LEN.pack(len(meta_bytes)))
+        out.write(meta_bytes)
+        out.write(blob)
+        out.write(key_table)
+        out.write(entry_table)
+    os.replace(tmp_path, index_path)
+
+
+def index_workers():
+    """Get the number of processes used to build the index"""
+    return int(os.environ.get('INDEX_WORKERS') or os.cpu_count() or 1)
+
+
+def shard_ranges(data_path, start, end, shards):
+    """Split [start, end) into byte ranges that begin right after a newline"""
+    bounds = [start]
+    with open(data_path, 'rb') as f:
+        for i in range(1, shards):
+            guess = start + (end - start) * i // shards
+            if guess <= bounds[-1]:
+                continue
+            f.seek(guess - 1)
+            f.readline()  # move past the line straddling the guess
+            boundary = min(f.tell(), end)
+            if boundary > bounds[-1]:
+                bounds.append(boundary)
+    bounds.append(end)
+    return [(bounds[i], bounds[i + 1]) for i in range(len(bounds) - 1) if bounds[i] < bounds[i + 1]]
+
+
+def _scan_shard(data_path, start, end, collector_type=None):
+    """Worker entry point: read the header from the first line, then scan one shard
+
+    With a collector_type, returns (index arrays, collector result).
+    """
+    with open(data_path, 'rb') as f:
+        headers, _ = read_header(f)
+    if collector_type is None:
+        return scan_range(data_path, headers, start, end)
+    collector = collector_type(headers)
+    return scan_range(data_path, headers, start, end, collector), collector.result()
+
+
+def _merge_shards(results):
+    """Merge per-shard key maps, in file order, into one set of index arrays"""
+    key_ids = {}
+    entry_keys = array('I')
+    offsets = array('Q')
+    lengths = array('I')
+    for keys, shard_keys, shard_offsets, shard_lengths in results:
+        remap = []
+        for key in keys:
+            key_id = key_ids.get(key)
+            if key_id is None:
+                key_id = key_ids[key] = len(key_ids)
+            remap.append(key_id)
+        entry_keys.extend(remap[key_id] for key_id in shard_keys)
+        offsets.extend(shard_offsets)
+        lengths.extend(shard_lengths)
+    return list(key_ids), entry_keys, offsets, lengths
+
+
+def scan_parallel(data_path, start, end, workers=None, progress=print, collector_type=None):
+    """Scan [start, end) with a process pool, one newline-aligned shard per task
+
+    collector_type(headers) objects see every record of their shard; their
+    results are combined with collector_type.merge() and returned after the
+    index arrays.
+    """
+    workers = workers or index_workers()
+    total = end - start
+    shards = min(workers * SHARDS_PER_WORKER, max(1, total // MIN_SHARD_BYTES))
+    if workers <= 1 or shards <= 1:
+        return _scan_shard(data_path, start, end, collector_type)
+
+    ranges = shard_ranges(data_path, start, end, shards)
+    results = [None] * len(ranges)
+    done_bytes = 0
+    # Imported here so processes that only read the index skip multiprocessing at startup
+    from concurrent.futures import ProcessPoolExecutor
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(_scan_shard, data_path, lo, hi, collector_type): i
+                   for i, (lo, hi) in enumerate(ranges)}
+        for done, future in enumerate(as_completed(futures), 1):
+            i = futures[future]
+            results[i] = future.result()
+            done_bytes += ranges[i][1] - ranges[i][0]
+            if progress:
+                progress(f"Indexed shard {done}/{len(ranges)} "
+                         f"({done_bytes * 100 // max(total, 1)}% of {total / 1e6:.0f} MB)")
+    if collector_type is None:
+        return _merge_shards(results)
+    return (_merge_shards([arrays for arrays, _ in results]),
+            collector_type.merge([collected for _, collected in results]))
+
+
+def _resume_offset(f, data_start, size):
+    """Find where scanning must resume if data is appended: just after the last \\n
+
+    Anything after it (a partial last line, or a trailing lone \\r) could be
+    continued by appended bytes, so it is scanned again together with them.
+    """
+    end = size
+    while end > data_start:
+        start = max(data_start, end - TAIL_CHECK_BYTES)
+        f.seek(start)
+        newline = f.read(end - start).rfind(b'\n')
+        if newline != -1:
+            return start + newline + 1
+        end = start
+    return data_start
+
+
+def append_state(data_path, data_start, size):
+    """Record what an append-only update needs to verify and where it resumes"""
+    with open(data_path, 'rb') as f:
+        header_sha = hashlib.sha256(f.read(data_start)).hexdigest()
+        resume_at = _resume_offset(f, data_start, size)
+        check_start = max(data_start, resume_at - TAIL_CHECK_BYTES)
+        f.seek(check_start)
+        tail_sha = hashlib.sha256(f.read(resume_at - check_start)).hexdigest()
+    return {'header_sha': header_sha, 'resume_at': resume_at, 'tail_sha': tail_sha}
+
+
+def build_index(data_path, index_path, workers=None, progress=print, collector_type=None):
+    """Scan the data file once and write its patient_id index
+
+    With a collector_type (see scan_parallel), returns (index, collected) so
+    another table can be built from the same pass.
+    """
+    size, mtime_ns = data_file_signature(data_path)
+    with open(data_path, 'rb') as f:
+        headers, data_start = read_header(f)
+    scanned = scan_parallel(data_path, data_start, size, workers, progress, collector_type)
+    if collector_type is not None:
+        scanned, collected = scanned
+    keys, entry_keys, offsets, lengths = scanned
+    meta = {
+        'source_size': size,
+        'source_mtime_ns': mtime_ns,
+        'headers': headers,
+        'data_start': data_start,
+        'append_state': append_state(data_path, data_start, size),
+    }
+    write_index(index_path, meta, keys, entry_keys, offsets, lengths)
+    if collector_type is not None:
+        return load_index(index_path), collected
+    return load_index(index_path)
+
+
+def is_append_of(previous, data_path):
+    """Check whether the data file only grew by appends since previous was built"""
+    state = previous.meta.get('append_state')
+    size, _ = data_file_signature(data_path)
+    if state is None or size <= previous.meta['source_size']:
+        return False
+    data_start = previous.meta['data_start']
+    resume_at = state['resume_at']
+    check_start = max(data_start, resume_at - TAIL_CHECK_BYTES)
+    with open(data_path, 'rb') as f:
+        if hashlib.sha256(f.read(data_start)).hexdigest() != state['header_sha']:
+            return False
+        f.seek(check_start)
+        return hashlib.sha256(f.read(resume_at - check_start)).hexdigest() == state['tail_sha']
+
+
+def append_index(data_path, index_path, previous, workers=None, progress=print):
+    """Index only the appended tail of the data file and merge it into previous"""
+    size, mtime_ns = data_file_signature(data_path)
+    resume_at = previous.meta['append_state']['resume_at']
+    headers = previous.headers
+
+    # Keep every previous entry that ends before the resume point
+    kept = previous.export(before=resume_at)
+    tail = scan_parallel(data_path, resume_at, size, workers, progress)
+    keys, entry_keys, offsets, lengths = _merge_shards([kept, tail])
+    meta = dict(
+        previous.meta,
+        source_size=size,
+        source_mtime_ns=mtime_ns,
+        append_state=append_state(data_path, previous.meta['data_start'], size),
+    )
+    write_index(index_path, meta, keys, entry_keys, offsets, lengths)
+    return load_index(index_path)
+
+
+def update_index(data_path, index_path, workers=None, progress=print):
+    """Bring the index up to date, appending when possible and rebuilding otherwise"""
+    try:
+        previous = load_index(index_path)
+    except (OSError, ValueError):
+        previous = None
+    if previous is not None and is_append_of(previous, data_path):
+        appended = data_file_signature(data_path)[0] - previous.meta['source_size']
+        print(f"Indexing {appended} appended bytes of {data_path}...")
+        return append_index(data_path, index_path, previous, workers, progress)
+    print(f"Building patient index for {data_path}...")
+    return build_index(data_path, index_path, workers, progress)
+
+
+class PatientIndex:
+    """Read-only, memory-mapped patient_id -> record location index.
+
+    Lookups binary search the sorted key table inside the mapping, so every
+    worker attached to the same index file shares its page cache instead of
+    building a private dict. A replaced index file is a new generation: the old
+    mapping stays valid for in-flight lookups and is released once unreferenced.
+    """
+
+    def __init__(self, index_path):
+        self.index_path = index_path
+        with open(index_path, 'rb') as f:
+            st = os.fstat(f.fileno())
+            self.file_id = (st.st_ino, st.st_mtime_ns, st.st_size)
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._map[:len(INDEX_MAGIC)] != INDEX_MAGIC:
+            raise ValueError(f"Not a patient index file: {index_path}")
+        pos = len(INDEX_MAGIC)
+        (meta_len,) = _META_LEN.unpack_from(self._map, pos)
+        pos += _META_LEN.size
+        self.meta = json.loads(self._map[pos:pos + meta_len])
+        if self.meta.get('version') != INDEX_VERSION:
+            raise ValueError(f"Unsupported index version in {index_path}")
+        self.headers = self.meta['headers']
+        self._blob_start = pos + meta_len
+        self._keys_start = self._blob_start + self.meta['blob_size']
+        self._entries_start = self._keys_start + self.meta['keys'] * _KEY_RECORD.size
+
+    def is_fresh(self, data_path):
+        """Check whether the index still matches the data file on disk"""
+        size, mtime_ns = data_file_signature(data_path)
+        return size == self.meta['source_size'] and mtime_ns == self.meta['source_mtime_ns']
+
+    def is_current(self):
+        """Check whether this mapping is still the index file's latest generation"""
+        try:
+            st = os.stat(self.index_path)
+        except OSError:
+            return False
+        return (st.st_ino, st.st_mtime_ns, st.st_size) == self.file_id
+
+    def _key_record(self, i):
+        key_off, key_len, first, count = _KEY_RECORD.unpack_from(
+            self._map, self._keys_start + i * _KEY_RECORD.size)
+        start = self._blob_start + key_off
+        return self._map[start:start + key_len].decode('utf-8'), first, count
+
+    def keys(self):
+        """Iterate over the indexed patient keys in sorted order"""
+        for i in range(self.meta['keys']):
+            yield self._key_record(i)[0]
+
+    def export(self, before=None):
+        """Return (keys, entry_keys, offsets, lengths) arrays, optionally only for records before an offset"""
+        keys = []
+        entry_keys = array('I')
+        offsets = array('Q')
+        lengths = array('I')
+        entries = _ENTRY.iter_unpack(self._map[self._entries_start:
+                                               self._entries_start + self.meta['entries'] * _ENTRY.size])
+        for i in range(self.meta['keys']):
+            key, _, count = self._key_record(i)
+            key_id = len(keys)
+            kept = 0
+            for _ in range(count):
+                offset, length = next(entries)
+                if before is None or offset < before:
+                    offsets.append(offset)
+                    lengths.append(length)
+                    kept += 1
+            if kept:
+                keys.append(key)
+                entry_keys.extend([key_id] * kept)
+        return keys, entry_keys, offsets, lengths
+
+    def locate(self, patient_id):
+        """Return the (offset, length) pairs of every record for a patient"""
+        key = patient_id.lower()
+        lo, hi = 0, self.meta['keys']
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._key_record(mid)[0] < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo == self.meta['keys']:
+            return []
+        found, first, count = self._key_record(lo)
+        if found != key:
+            return []
+        start = self._entries_start + first * _ENTRY.size
+        return [_ENTRY.unpack_from(self._map, start + i * _ENTRY.size) for i in range(count)]
+
+
+def load_index(index_path):
+    """Attach to an index file on disk"""
+    return PatientIndex(index_path)
+
+
+class BuildLock:
+    """Cross-process lock so only one process (or thread) builds a generation of a file"""
+
+    def __init__(self, index_path, blocking=True):
+        self.path = f"{index_path}.lock"
+        self.blocking = blocking
+        self.acquired = False
+        self._file = None
+
+    def __enter__(self):
+        self._file = open(self.path, 'a')
+        if fcntl is not None:
+            flags = fcntl.LOCK_EX if self.blocking else fcntl.LOCK_EX | fcntl.LOCK_NB
+            try:
+                fcntl.flock(self._file.fileno(), flags)
+                self.acquired = True
+            except BlockingIOError:
+                pass
+        else:
+            self.acquired = _local_build_locks.setdefault(self.path, threading.Lock()).acquire(
+                blocking=self.blocking)
+        return self.acquired
+
+    def __exit__(self, *exc):
+        if self.acquired:
+            if fcntl is not None:
+                fcntl.flock(self._file.fileno(), fcntl.LOCK_UN)
+            else:
+                _local_build_locks[self.path].release()
+        self._file.close()
+
+
+def _attach_index(data_path, index_path):
+    """Return the newest index generation on disk if it matches the data file"""
+    global _loaded_index
+    index = _loaded_index
+    if index is None or index.index_path != index_path or not index.is_current():
+        try:
+            index = load_index(index_path)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            print(f"Warning: Ignoring unreadable index {index_path}: {e}")
+            return None
+        # The previous generation is released once in-flight lookups drop it
+        _loaded_index = index
+    return index if index.is_fresh(data_path) else None
+
+
+def _build_generation(data_path, index_path, blocking=True):
+    """Build a new index generation unless another process already is (or just did)"""
+    with BuildLock(index_path, blocking) as acquired:
+        if not acquired:
+            return None
+        with _index_lock:
+            index = _attach_index(data_path, index_path)
+        if index is not None:
+            return index
+        update_index(data_path, index_path)
+        with _index_lock:
+            index = _attach_index(data_path, index_path)
+        if index is not None:
+            print(f"Indexed {index.meta['entries']} rows for {index.meta['keys']} patients")
+        return index
+
+
+class BackgroundBuild:
+    """Runs at most one background build of a derived file per process.
+
+    build(data_path, path) returns something falsy when another process holds
+    the build lock, in which case the next attempt waits BUILD_RETRY_SECONDS. A
+    build that raises is not retried until the data file changes again.
+    """
+
+    def __init__(self, name, description, build, lock):
+        self.name = name
+        self.description = description
+        self.build = build
+        self.lock = lock
+        self.thread = None
+        self.failed_signature = None
+        self.next_attempt = 0.0
+
+    @property
+    def running(self):
+        return self.thread is not None
+
+    def start(self, data_path, path):
+        """Start a build on a background thread unless one is running, failed or waiting to retry"""
+        signature = data_file_signature(data_path)
+        with self.lock:
+            if self.thread is None and self.failed_signature != signature \
+                    and time.monotonic() >= self.next_attempt:
+                self.thread = threading.Thread(
+                    target=self._run, args=(data_path, path, signature),
+                    name=f"{self.name}-build", daemon=True)
+                self.thread.start()
+
+    def _run(self, data_path, path, signature):
+        try:
+            if not self.build(data_path, path):
+                # Another process holds the build lock; check back later for its result
+                self.next_attempt = time.monotonic() + BUILD_RETRY_SECONDS
+        except Exception as e:
+            print(f"Warning: Background {self.description} build failed: {e}")
+            self.failed_signature = signature
+        finally:
+            self.thread = None
+
+
+_background = BackgroundBuild(
+    'index', 'index',
+    lambda data_path, index_path: _build_generation(data_path, index_path, blocking=False),
+    _index_lock)
+
+
+def index_status(data_path, index_path=None):
+    """Describe the on-disk index and whether it matches the data file, without building one"""
+    index_path = index_path or default_index_path(data_path)
+    with _index_lock:
+        index = _attach_index(data_path, index_path)
+        loaded = _loaded_index if _loaded_index is not None and _loaded_index.index_path == index_path else None
+        building = _background.running
+    status = {'path': index_path, 'fresh': index is not None, 'building': building}
+    if loaded is not None:
+        status.update(
+            entries=loaded.meta['entries'],
+            patients=loaded.meta['keys'],
+            source_size=loaded.meta['source_size'],
+            source_mtime=loaded.meta['source_mtime_ns'] / 1e9,
+        )
+    return status
+
+
+def get_index(data_path, index_path=None, wait=True):
+    """Return an index matching the current data file.
+
+    With wait=True a missing or stale index is built before returning. With
+    wait=False the new generation is built on a background thread and None is
+    returned meanwhile, so callers can fall back to scanning the data file.
+    """
+    index_path = index_path or default_index_path(data_path)
+    with _index_lock:
+        index = _attach_index(data_path, index_path)
+    if index is not None:
+        return index
+    if wait:
+        return _build_generation(data_path, index_path)
+
+    _background.start(data_path, index_path)
+    return None
@@ -0,0 +1,40 @@
+# Gunicorn hooks; bind/workers/timeout are given on the command line (see render.yaml)
+import os
+
+
+def on_starting(server):
+    """Build the shared patient index and search catalog once in the master, before any worker forks
+
+    A cold build reads the data file once for both (see update_index_and_catalog).
+    Workers then attach to the same memory-mapped index file read-only. When the
+    data file changes later, one process builds the next generation in the
+    background and every worker switches to it once it is in place. The PDF
+    renderer is imported here too, so forked workers start with it loaded.
+    """
+    import bill_render
+    import patient_catalog
+    from app import FILE_PATH, INDEX_PATH, CATALOG_PATH
+
+    bill_render.preload()
+
+    if not os.path.exists(FILE_PATH):
+        server.log.warning(f"Data file not found at {FILE_PATH}; skipping index build")
+        return
+    try:
+        index, _ = patient_catalog.update_index_and_catalog(FILE_PATH, INDEX_PATH, CATALOG_PATH)
+        server.log.info(f"Patient index and search catalog ready: {index.meta['keys']} patients, "
+                        f"{INDEX_PATH}, {CATALOG_PATH}")
+    except Exception as e:
+        server.log.warning(f"Could not build patient index and catalog, workers will retry: {e}")
+
+
+def post_fork(server, worker):
+    """Attach each worker to the index and catalog and start its cache warm-up (see WARMUP in app.py)
+
+    /health answers 503 until the worker is warm, so it only takes traffic once
+    its index pages, font metrics and warm-up bills are loaded.
+    """
+    import app
+
+    app.load_patient_index()
+    app.start_warmup()
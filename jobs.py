@@ -0,0 +1,120 @@
+import os
+import time
+import uuid
+import sqlite3
+import threading
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    patient_id TEXT NOT NULL,
+    status TEXT NOT NULL,
+    total INTEGER NOT NULL DEFAULT 0,
+    done INTEGER NOT NULL DEFAULT 0,
+    error TEXT,
+    result_path TEXT,
+    worker_pid INTEGER,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL
+)
+"""
+
+# Job states
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class JobStore:
+    """SQLite-backed record of bill generation jobs and their result files.
+
+    The database and finished ZIPs live in one local directory, so every
+    gunicorn worker on the machine sees the same jobs without another service.
+    """
+
+    def __init__(self, directory, ttl_seconds=24 * 3600):
+        self.directory = directory
+        self.ttl_seconds = ttl_seconds
+        self.db_path = os.path.join(directory, 'jobs.sqlite3')
+        self._local = threading.local()
+        os.makedirs(directory, exist_ok=True)
+        with self._connect() as conn:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute(SCHEMA)
+
+    def _connect(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._local.conn = sqlite3.connect(self.db_path, timeout=30)
+            conn.row_factory = sqlite3.Row
+        return conn
+
+    def result_path(self, job_id):
+        """Get where a job's finished ZIP is written"""
+        return os.path.join(self.directory, f"{job_id}.zip")
+
+    def create(self, patient_id):
+        """Queue a new job and return its ID"""
+        self.purge_expired()
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute(
+                'INSERT INTO jobs (id, patient_id, status, worker_pid, created_at, updated_at) '
+                'VALUES (?, ?, ?, ?, ?, ?)',
+                (job_id, patient_id, QUEUED, os.getpid(), now, now))
+        return job_id
+
+    def _update(self, job_id, **fields):
+        fields['updated_at'] = time.time()
+        assignments = ', '.join(f"{name} = ?" for name in fields)
+        with self._connect() as conn:
+            conn.execute(f'UPDATE jobs SET {assignments} WHERE id = ?', (*fields.values(), job_id))
+
+    def start(self, job_id, total):
+        self._update(job_id, status=RUNNING, total=total, done=0)
+
+    def progress(self, job_id, done):
+        self._update(job_id, done=done)
+
+    def finish(self, job_id, result_path):
+        self._update(job_id, status=DONE, result_path=result_path)
+
+    def fail(self, job_id, error):
+        self._update(job_id, status=FAILED, error=error)
+
+    def get(self, job_id):
+        """Return a job as a dict, or None"""
+        with self._connect() as conn:
+            row = conn.execute('SELECT * FROM jobs WHERE id = ?', (job_id,)).fetchone()
+        if row is None:
+            return None
+        job = dict(row)
+        if job['status'] in (QUEUED, RUNNING) and not _pid_alive(job['worker_pid']):
+            # The worker that owned the job is gone (restart or crash)
+            self.fail(job_id, 'Worker stopped before the job finished')
+            job.update(status=FAILED, error='Worker stopped before the job finished')
+        return job
+
+    def purge_expired(self):
+        """Delete jobs, and their files, older than the TTL"""
+        cutoff = time.time() - self.ttl_seconds
+        with self._connect() as conn:
+            expired = conn.execute('SELECT id FROM jobs WHERE created_at < ?', (cutoff,)).fetchall()
+            conn.execute('DELETE FROM jobs WHERE created_at < ?', (cutoff,))
+        for row in expired:
+            try:
+                os.remove(self.result_path(row['id']))
+            except OSError:
+                pass
@@ -0,0 +1,131 @@
+import time
+import threading
+from collections import defaultdict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import wraps
+
+# Upper bounds, in seconds, of the stage latency histogram buckets
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+COUNTERS = {
+    'rows_scanned': "Data file records read while searching for patients",
+    'rows_matched': "Claim lines returned for searched patients",
+    'pdfs_rendered': "Bills rendered because no cached PDF matched",
+    'bytes_out': "Bill ZIP bytes sent to clients",
+}
+
+_lock = threading.Lock()
+_counters = defaultdict(float)
+# stage -> [per-bucket counts, +Inf count, sum of seconds]
+_histograms = {}
+# Spans of the request being served, for its Server-Timing header
+_request_spans = ContextVar('request_spans', default=None)
+
+
+def inc(name, amount=1):
+    """Add to one of the COUNTERS"""
+    with _lock:
+        _counters[name] += amount
+
+
+def observe(stage, seconds):
+    """Record how long one run of a stage took"""
+    with _lock:
+        histogram = _histograms.get(stage)
+        if histogram is None:
+            histogram = _histograms[stage] = [[0] * len(BUCKETS), 0, 0.0]
+        for i, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                histogram[0][i] += 1
+                break
+        histogram[1] += 1
+        histogram[2] += seconds
+    spans = _request_spans.get()
+    if spans is not None:
+        spans.append((stage, seconds))
+
+
+@contextmanager
+def span(stage):
+    """Time the enclosed block as one run of stage"""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(stage, time.perf_counter() - started)
+
+
+def timed(stage):
+    """Decorate a function so every call is timed as stage"""
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(stage):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+@contextmanager
+def request_timings():
+    """Collect the spans recorded while serving one request"""
+    spans = []
+    token = _request_spans.set(spans)
+    try:
+        yield spans
+    finally:
+        _request_spans.reset(token)
+
+
+def server_timing(spans):
+    """Format collected spans as a Server-Timing header, one entry per stage"""
+    totals = {}
+    for stage, seconds in spans:
+        total, count = totals.get(stage, (0.0, 0))
+        totals[stage] = (total + seconds, count + 1)
+    return ', '.join(
+        f'{stage};dur={total * 1000:.1f}' + (f';desc="{count} runs"' if count > 1 else '')
+        for stage, (total, count) in totals.items())
+
+
+def render(caches=None):
+    """Render all metrics in the Prometheus text exposition format
+
+    caches maps a cache name to a BillCache whose stats() are exported too.
+    """
+    with _lock:
+        counters = dict(_counters)
+        histograms = {stage: (list(buckets), count, total)
+                      for stage, (buckets, count, total) in _histograms.items()}
+
+    lines = []
+    for name, help_text in COUNTERS.items():
+        lines.append(f"# HELP bill_{name}_total {help_text}")
+        lines.append(f"# TYPE bill_{name}_total counter")
+        lines.append(f"bill_{name}_total {counters.get(name, 0):g}")
+
+    lines.append("# HELP bill_stage_seconds Time spent in each stage of bill generation")
+    lines.append("# TYPE bill_stage_seconds histogram")
+    for stage, (buckets, count, total) in sorted(histograms.items()):
+        cumulative = 0
+        for bound, bucket_count in zip(BUCKETS, buckets):
+            cumulative += bucket_count
+            lines.append(f'bill_stage_seconds_bucket{{stage="{stage}",le="{bound:g}"}} {cumulative}')
+        lines.append(f'bill_stage_seconds_bucket{{stage="{stage}",le="+Inf"}} {count}')
+        lines.append(f'bill_stage_seconds_sum{{stage="{stage}"}} {total:.6f}')
+        lines.append(f'bill_stage_seconds_count{{stage="{stage}"}} {count}')
+
+    if caches:
+        stats = {name: cache.stats() for name, cache in caches.items()}
+        for field, kind, help_text in (
+                ('hits', 'counter', "Bill cache lookups that found an entry"),
+                ('misses', 'counter', "Bill cache lookups that found nothing"),
+                ('entries', 'gauge', "Entries held in memory by the bill cache"),
+                ('bytes', 'gauge', "Bytes held in memory by the bill cache")):
+            metric = f"bill_cache_{field}_total" if kind == 'counter' else f"bill_cache_{field}"
+            lines.append(f"# HELP {metric} {help_text}")
+            lines.append(f"# TYPE {metric} {kind}")
+            for name, values in stats.items():
+                lines.append(f'{metric}{{cache="{name}"}} {values[field]}')
+    return '\n'.join(lines) + '\n'
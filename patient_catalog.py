@@ -0,0 +1,550 @@
+import os
+import re
+import json
+import shutil
+import sqlite3
+import threading
+from datetime import datetime
+from functools import lru_cache
+
+import data_index
+
+# Per-patient lookup tables and billing totals built from one pass over the
+# data file, so searches and summaries never read the data file itself
+CATALOG_VERSION = 2
+
+SCHEMA = """
+CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT NOT NULL);
+CREATE TABLE patients (
+    patient_key TEXT PRIMARY KEY,
+    patient_id TEXT NOT NULL,
+    patient_name TEXT NOT NULL,
+    lines INTEGER NOT NULL,
+    total_charges REAL NOT NULL,
+    icd_codes TEXT NOT NULL
+) WITHOUT ROWID;
+CREATE TABLE visits (
+    patient_key TEXT NOT NULL,
+    date_of_service TEXT NOT NULL,
+    date_key TEXT,
+    lines INTEGER NOT NULL,
+    total_charges REAL NOT NULL,
+    icd_codes TEXT NOT NULL,
+    providers TEXT NOT NULL,
+    PRIMARY KEY (patient_key, date_of_service)
+) WITHOUT ROWID;
+CREATE TABLE providers (
+    patient_key TEXT NOT NULL,
+    provider TEXT NOT NULL,
+    PRIMARY KEY (patient_key, provider)
+) WITHOUT ROWID;
+CREATE TABLE terms (
+    kind TEXT NOT NULL,
+    token TEXT NOT NULL,
+    patient_key TEXT NOT NULL,
+    PRIMARY KEY (kind, token, patient_key)
+) WITHOUT ROWID;
+"""
+INDEXES = """
+CREATE INDEX visits_by_date ON visits (date_key, patient_key);
+"""
+
+# Formats tried, in order, to turn date_of_service into a sortable YYYY-MM-DD key
+DATE_FORMATS = ('%m/%d/%Y', '%Y-%m-%d', '%m-%d-%Y', '%m/%d/%y', '%Y%m%d')
+# Sorts after any token that starts with the searched prefix
+_PREFIX_END = '\U0010ffff'
+_NON_WORD = re.compile(r'[\W_]+')
+
+_catalog_lock = threading.Lock()
+_loaded_catalog = None
+
+
+def default_catalog_path(data_path):
+    """Get the path of the catalog database that belongs to a data file"""
+    return os.environ.get('CATALOG_PATH') or f"{data_path}.catalog"
+
+
+def provider_name(first_name, last_name):
+    """Format a rendering provider the way bills print it, or '' when unnamed"""
+    first_name, last_name = first_name.strip(), last_name.strip()
+    if first_name and last_name:
+        return f"Dr. {first_name} {last_name}"
+    if first_name or last_name:
+        return f"Dr. {first_name or last_name}"
+    return ''
+
+
+def search_tokens(text):
+    """Split a name into lowercase words, ignoring punctuation and order"""
+    return [token for token in _NON_WORD.split(text.casefold()) if token]
+
+
+@lru_cache(maxsize=65536)
+def date_key(value):
+    """Normalize a date of service to YYYY-MM-DD, or None when it cannot be parsed"""
+    value = value.strip()
+    for date_format in DATE_FORMATS:
+        try:
+            return datetime.strptime(value, date_format).strftime('%Y-%m-%d')
+        except ValueError:
+            continue
+    return None
+
+
+def line_charge(charges):
+    """Parse a Charges value the way the bill's services table totals it"""
+    try:
+        return float(charges or 0)
+    except (ValueError, TypeError):
+        return 0.0
+
+
+class CatalogScan:
+    """Collects each patient's ID, name, visits and providers from parsed records
+
+    Used on its own for appended data, and as the collector of the index scan
+    (data_index.build_index) so a full build reads the data file only once.
+    result() is {patient_key: [patient_id, patient_name, visits, providers]}
+    where visits maps each date of service to [lines, total_charges,
+    icd_codes, providers]. ICD codes and providers are insertion-ordered dicts
+    used as sets.
+    """
+
+    def __init__(self, headers):
+        self.columns = {name: i for i, name in enumerate(headers)}
+        self.pid_col = self.columns.get('patient_id')
+        self.patients = {}
+
+    def _column(self, cols, name):
+        i = self.columns.get(name)
+        return cols[i] if i is not None else ''
+
+    def add(self, cols):
+        if self.pid_col is None:
+            return
+        column = self._column
+        patient_id = cols[self.pid_col]
+        key = patient_id.lower()
+        patient = self.patients.get(key)
+        if patient is None:
+            patient = self.patients[key] = [patient_id, column(cols, 'patient_name'), {}, {}]
+        service_date = column(cols, 'date_of_service').strip()
+        visit = patient[2].get(service_date)
+        if visit is None:
+            visit = patient[2][service_date] = [0, 0.0, {}, {}]
+        visit[0] += 1
+        visit[1] += line_charge(column(cols, 'Charges'))
+        # Same rule as extract_service_date_icd_codes(): dated lines only,
+        # but split into single codes so each one is counted once
+        if service_date:
+            for code in column(cols, 'diagnosis_dxs').split(','):
+                code = code.strip()
+                if code:
+                    visit[2][code] = None
+        provider = provider_name(column(cols, 'rendering_first_name'),
+                                 column(cols, 'rendering_last_name'))
+        if provider:
+            visit[3][provider] = None
+            patient[3][provider] = None
+
+    def result(self):
+        return self.patients
+
+    @staticmethod
+    def merge(results):
+        return _merge_patients(results)
+
+
+def scan_catalog(data_path, start, end=None):
+    """Collect the catalog patients (see CatalogScan) of one byte range"""
+    with open(data_path, 'rb') as f:
+        headers, data_start = data_index.read_header(f)
+        collector = CatalogScan(headers)
+        for _, body in data_index.iter_records(f, max(start, data_start), end):
+            cols = data_index.parse_record(body, headers)
+            if cols is not None:
+                collector.add(cols)
+    return collector.result()
+
+
+def _merge_patients(results):
+    """Merge per-shard patient maps in file order; the first ID and name seen win"""
+    merged = {}
+    for patients in results:
+        for key, (patient_id, patient_name, visits, providers) in patients.items():
+            patient = merged.get(key)
+            if patient is None:
+                merged[key] = [patient_id, patient_name, visits, providers]
+                continue
+            for service_date, (lines, total, icd_codes, visit_providers) in visits.items():
+                visit = patient[2].get(service_date)
+                if visit is None:
+                    patient[2][service_date] = [lines, total, icd_codes, visit_providers]
+                else:
+                    visit[0] += lines
+                    visit[1] += total
+                    visit[2].update(icd_codes)
+                    visit[3].update(visit_providers)
+            patient[3].update(providers)
+    return merged
+
+
+def scan_catalog_parallel(data_path, start, end, workers=None):
+    """Scan [start, end) in newline-aligned shards on a process pool"""
+    workers = workers or data_index.index_workers()
+    shards = min(workers * data_index.SHARDS_PER_WORKER,
+                 max(1, (end - start) // data_index.MIN_SHARD_BYTES))
+    if workers <= 1 or shards <= 1:
+        return scan_catalog(data_path, start, end)
+    ranges = data_index.shard_ranges(data_path, start, end, shards)
+    from concurrent.futures import ProcessPoolExecutor
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        results = list(pool.map(scan_catalog, [data_path] * len(ranges), *zip(*ranges)))
+    return _merge_patients(results)
+
+
+def _insert_patients(conn, patients, verb='INSERT'):
+    """Write patient maps as catalog rows; verb 'INSERT OR REPLACE' overwrites merged patients"""
+    keys = sorted(patients)
+    patient_rows = []
+    visit_rows = []
+    for key in keys:
+        patient_id, patient_name, visits, _ = patients[key]
+        lines = 0
+        total = 0.0
+        icd_codes = {}
+        for service_date in sorted(visits):
+            visit_lines, visit_total, visit_icds, visit_providers = visits[service_date]
+            lines += visit_lines
+            total += visit_total
+            icd_codes.update(visit_icds)
+            visit_rows.append((key, service_date, date_key(service_date), visit_lines, visit_total,
+                               json.dumps(sorted(visit_icds)), json.dumps(sorted(visit_providers))))
+        patient_rows.append((key, patient_id, patient_name, lines, total, json.dumps(sorted(icd_codes))))
+    conn.executemany(f'{verb} INTO patients VALUES (?, ?, ?, ?, ?, ?)', patient_rows)
+    conn.executemany(f'{verb} INTO visits VALUES (?, ?, ?, ?, ?, ?, ?)', visit_rows)
+    conn.executemany(f'{verb} INTO providers VALUES (?, ?)',
+                     ((key, provider) for key in keys for provider in sorted(patients[key][3])))
+    terms = set()
+    for key, (_, patient_name, _, providers) in patients.items():
+        terms.update(('name', token, key) for token in search_tokens(patient_name))
+        for provider in providers:
+            terms.update(('provider', token, key) for token in search_tokens(provider[len('Dr. '):]))
+    conn.executemany(f'{verb} INTO terms VALUES (?, ?, ?)', sorted(terms))
+
+
+def _write_meta(conn, meta):
+    meta = dict(meta, version=CATALOG_VERSION)
+    conn.executemany('INSERT OR REPLACE INTO meta VALUES (?, ?)',
+                     [(name, json.dumps(value)) for name, value in meta.items()])
+
+
+def write_catalog(catalog_path, meta, patients):
+    """Write the catalog tables to a fresh database and move it into place atomically"""
+    tmp_path = data_index.builder_tmp_path(catalog_path)
+    conn = sqlite3.connect(tmp_path)
+    try:
+        conn.execute('PRAGMA journal_mode=OFF')
+        conn.execute('PRAGMA synchronous=OFF')
+        conn.executescript(SCHEMA)
+        _write_meta(conn, meta)
+        _insert_patients(conn, patients)
+        conn.executescript(INDEXES)
+        conn.commit()
+    finally:
+        conn.close()
+    os.replace(tmp_path, catalog_path)
+
+
+def _catalog_meta(data_path, size, mtime_ns):
+    with open(data_path, 'rb') as f:
+        _, data_start = data_index.read_header(f)
+    return {
+        'source_size': size,
+        'source_mtime_ns': mtime_ns,
+        'data_start': data_start,
+        'append_state': data_index.append_state(data_path, data_start, size),
+    }
+
+
+def build_catalog(data_path, catalog_path, workers=None):
+    """Scan the whole data file and write its patient catalog"""
+    size, mtime_ns = data_index.data_file_signature(data_path)
+    patients = scan_catalog_parallel(data_path, 0, size, workers)
+    write_catalog(catalog_path, _catalog_meta(data_path, size, mtime_ns), patients)
+    return PatientCatalog(catalog_path)
+
+
+def can_append(previous, data_path):
+    """Check whether previous can be brought up to date by scanning only appended bytes
+
+    Totals cannot be taken back out, so a catalog that counted an unterminated
+    last line (which appended bytes may continue) needs a full rebuild instead.
+    """
+    state = previous.meta.get('append_state')
+    return (state is not None and state['resume_at'] == previous.meta['source_size']
+            and data_index.is_append_of(previous, data_path))
+
+
+def append_catalog(data_path, catalog_path, previous, workers=None):
+    """Scan only the appended tail of the data file and merge it into a copy of previous"""
+    size, mtime_ns = data_index.data_file_signature(data_path)
+    tail = scan_catalog_parallel(data_path, previous.meta['source_size'], size, workers)
+
+    tmp_path = data_index.builder_tmp_path(catalog_path)
+    shutil.copyfile(previous.catalog_path, tmp_path)
+    conn = sqlite3.connect(tmp_path)
+    try:
+        conn.execute('PRAGMA journal_mode=OFF')
+        conn.execute('PRAGMA synchronous=OFF')
+        # Patients already in the catalog come first, so their ID and name win
+        merged = _merge_patients([previous.load_patients(tail, conn), tail])
+        _insert_patients(conn, merged, 'INSERT OR REPLACE')
+        _write_meta(conn, dict(previous.meta, **_catalog_meta(data_path, size, mtime_ns)))
+        conn.commit()
+    finally:
+        conn.close()
+    os.replace(tmp_path, catalog_path)
+    return PatientCatalog(catalog_path)
+
+
+def update_catalog(data_path, catalog_path, workers=None):
+    """Bring the catalog up to date, appending when possible and rebuilding otherwise"""
+    try:
+        previous = PatientCatalog(catalog_path)
+    except (OSError, ValueError, sqlite3.Error):
+        previous = None
+    if previous is not None and can_append(previous, data_path):
+        return append_catalog(data_path, catalog_path, previous, workers)
+    return build_catalog(data_path, catalog_path, workers)
+
+
+def update_index_and_catalog(data_path, index_path, catalog_path, workers=None, full=False, progress=print):
+    """Bring the patient index and the catalog up to date together; returns (index, catalog)
+
+    When both need a full build, the catalog is collected inside the index scan
+    so the data file is read once. Otherwise each is appended to or rebuilt on
+    its own. Both build locks are held, index first, as every builder takes them.
+    """
+    with data_index.BuildLock(index_path), data_index.BuildLock(catalog_path):
+        try:
+            index = data_index.load_index(index_path)
+        except (OSError, ValueError):
+            index = None
+        try:
+            catalog = PatientCatalog(catalog_path)
+        except (OSError, ValueError, sqlite3.Error):
+            catalog = None
+        index_full = full or index is None or not (
+            index.is_fresh(data_path) or data_index.is_append_of(index, data_path))
+        catalog_full = full or catalog is None or not (
+            catalog.is_fresh(data_path) or can_append(catalog, data_path))
+
+        if index_full and catalog_full:
+            print(f"Building patient index and catalog for {data_path}...")
+            index, patients = data_index.build_index(data_path, index_path, workers, progress, CatalogScan)
+            meta = _catalog_meta(data_path, index.meta['source_size'], index.meta['source_mtime_ns'])
+            write_catalog(catalog_path, meta, patients)
+            return index, PatientCatalog(catalog_path)
+
+        if index_full:
+            index = data_index.build_index(data_path, index_path, workers, progress)
+        elif not index.is_fresh(data_path):
+            index = data_index.update_index(data_path, index_path, workers, progress)
+        if catalog_full:
+            catalog = build_catalog(data_path, catalog_path, workers)
+        elif not catalog.is_fresh(data_path):
+            catalog = append_catalog(data_path, catalog_path, catalog, workers)
+        return index, catalog
+
+
+class PatientCatalog:
+    """Read-only view of a catalog database, with one connection per thread.
+
+    A connection keeps reading the generation it opened even after a rebuild
+    replaces the file, so every query sees one consistent snapshot.
+    """
+
+    def __init__(self, catalog_path):
+        self.catalog_path = catalog_path
+        st = os.stat(catalog_path)
+        self.file_id = (st.st_ino, st.st_mtime_ns, st.st_size)
+        self._local = threading.local()
+        self.meta = {row[0]: json.loads(row[1]) for row in
+                     self._connect().execute('SELECT key, value FROM meta')}
+        if self.meta.get('version') != CATALOG_VERSION:
+            raise ValueError(f"Unsupported catalog version in {catalog_path}")
+
+    def _connect(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._local.conn = sqlite3.connect(
+                f"file:{self.catalog_path}?mode=ro", uri=True, check_same_thread=False)
+        return conn
+
+    def is_fresh(self, data_path):
+        """Check whether the catalog was built from the data file as it is now"""
+        size, mtime_ns = data_index.data_file_signature(data_path)
+        return size == self.meta['source_size'] and mtime_ns == self.meta['source_mtime_ns']
+
+    def is_current(self):
+        """Check whether this is still the newest catalog file on disk"""
+        try:
+            st = os.stat(self.catalog_path)
+        except OSError:
+            return False
+        return (st.st_ino, st.st_mtime_ns, st.st_size) == self.file_id
+
+    def search(self, name=None, date_from=None, date_to=None, provider=None, limit=50):
+        """Find patients matching every given filter, in patient_id order
+
+        name and provider match each word as a prefix of a word in the name,
+        in any order. date_from/date_to are inclusive YYYY-MM-DD bounds.
+        Returns (patients, truncated).
+        """
+        clauses = []
+        params = []
+        for kind, text in (('name', name), ('provider', provider)):
+            for token in search_tokens(text or ''):
+                clauses.append('patient_key IN (SELECT patient_key FROM terms '
+                               'WHERE kind = ? AND token >= ? AND token < ?)')
+                params += [kind, token, token + _PREFIX_END]
+        date_clause = ''
+        date_params = []
+        if date_from or date_to:
+            date_clause = ' AND date_key BETWEEN ? AND ?'
+            date_params = [date_from or '0000-00-00', date_to or '9999-99-99']
+            clauses.append(f'patient_key IN (SELECT patient_key FROM visits WHERE 1{date_clause})')
+            params += date_params
+        if not clauses:
+            raise ValueError("At least one search filter is required")
+
+        conn = self._connect()
+        found = conn.execute(
+            f"SELECT patient_key, patient_id, patient_name FROM patients "
+            f"WHERE {' AND '.join(clauses)} ORDER BY patient_key LIMIT ?",
+            (*params, limit + 1)).fetchall()
+        results = []
+        for key, patient_id, patient_name in found[:limit]:
+            dates = [row[0] for row in conn.execute(
+                f"SELECT date_of_service FROM visits WHERE patient_key = ?{date_clause} "
+                f"ORDER BY date_key, date_of_service", (key, *date_params))]
+            providers = [row[0] for row in conn.execute(
+                'SELECT provider FROM providers WHERE patient_key = ?', (key,))]
+            results.append({'patient_id': patient_id, 'patient_name': patient_name,
+                            'dates_of_service': dates, 'providers': providers})
+        return results, len(found) > limit
+
+    def recent_patients(self, count):
+        """Get the IDs of the count patients with the latest dates of service, newest first"""
+        if count <= 0:
+            return []
+        conn = self._connect()
+        keys = {}
+        for (key,) in conn.execute('SELECT patient_key FROM visits WHERE date_key IS NOT NULL '
+                                   'ORDER BY date_key DESC, patient_key'):
+            keys[key] = None
+            if len(keys) >= count:
+                break
+        return [conn.execute('SELECT patient_id FROM patients WHERE patient_key = ?', (key,)).fetchone()[0]
+                for key in keys]
+
+    def load_patients(self, keys, conn=None):
+        """Read the catalog entries of the given patient keys back into scan_catalog() form"""
+        conn = conn or self._connect()
+        patients = {}
+        for key in keys:
+            row = conn.execute('SELECT patient_id, patient_name FROM patients WHERE patient_key = ?',
+                               (key,)).fetchone()
+            if row is None:
+                continue
+            visits = {}
+            for service_date, lines, total, icd_codes, providers in conn.execute(
+                    'SELECT date_of_service, lines, total_charges, icd_codes, providers '
+                    'FROM visits WHERE patient_key = ?', (key,)):
+                visits[service_date] = [lines, total, dict.fromkeys(json.loads(icd_codes)),
+                                        dict.fromkeys(json.loads(providers))]
+            providers = dict.fromkeys(provider for (provider,) in conn.execute(
+                'SELECT provider FROM providers WHERE patient_key = ?', (key,)))
+            patients[key] = [row[0], row[1], visits, providers]
+        return patients
+
+    def summary(self, patient_id, date_of_service=None):
+        """Get a patient's billing totals overall and per date of service, or None if unknown
+
+        Totals are summed the same way as the bill's TOTAL line and rounded to cents.
+        """
+        key = patient_id.lower()
+        conn = self._connect()
+        row = conn.execute('SELECT patient_id, patient_name, lines, total_charges, icd_codes '
+                           'FROM patients WHERE patient_key = ?', (key,)).fetchone()
+        if row is None:
+            return None
+        query = ('SELECT date_of_service, lines, total_charges, icd_codes, providers '
+                 'FROM visits WHERE patient_key = ?')
+        params = (key,)
+        if date_of_service is not None:
+            query += ' AND date_of_service = ?'
+            params += (date_of_service.strip(),)
+        dates = [{'date_of_service': service_date, 'lines': lines,
+                  'total_charges': round(total, 2), 'icd_codes': json.loads(icd_codes),
+                  'providers': json.loads(providers)}
+                 for service_date, lines, total, icd_codes, providers in
+                 conn.execute(query + ' ORDER BY date_key, date_of_service', params)]
+        providers = [provider for (provider,) in conn.execute(
+            'SELECT provider FROM providers WHERE patient_key = ?', (key,))]
+        return {'patient_id': row[0], 'patient_name': row[1], 'lines': row[2],
+                'total_charges': round(row[3], 2), 'icd_codes': json.loads(row[4]),
+                'providers': providers, 'dates': dates}
+
+
+def _attach_catalog(data_path, catalog_path):
+    """Return the newest catalog on disk, fresh or not, or None when there is none"""
+    global _loaded_catalog
+    catalog = _loaded_catalog
+    if catalog is None or catalog.catalog_path != catalog_path or not catalog.is_current():
+        try:
+            catalog = PatientCatalog(catalog_path)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError, sqlite3.Error) as e:
+            print(f"Warning: Ignoring unreadable patient catalog {catalog_path}: {e}")
+            return None
+        _loaded_catalog = catalog
+    return catalog
+
+
+def _build_generation(data_path, catalog_path):
+    """Build a new catalog unless another process already is (or just did)"""
+    with data_index.BuildLock(catalog_path) as acquired:
+        if not acquired:
+            return None
+        with _catalog_lock:
+            catalog = _attach_catalog(data_path, catalog_path)
+        if catalog is not None and catalog.is_fresh(data_path):
+            return catalog
+        update_catalog(data_path, catalog_path)
+        with _catalog_lock:
+            return _attach_catalog(data_path, catalog_path)
+
+
+_background = data_index.BackgroundBuild('catalog', 'patient catalog', _build_generation, _catalog_lock)
+
+
+def get_catalog(data_path, catalog_path=None, wait=True):
+    """Return the catalog for data_path.
+
+    With wait=True a missing or stale catalog is rebuilt first. With wait=False
+    a rebuild is started in the background and the previous generation, which
+    may be stale or None, is returned meanwhile; check is_fresh() on it.
+    """
+    catalog_path = catalog_path or default_catalog_path(data_path)
+    with _catalog_lock:
+        catalog = _attach_catalog(data_path, catalog_path)
+    if catalog is not None and catalog.is_fresh(data_path):
+        return catalog
+    if wait:
+        return _build_generation(data_path, catalog_path)
+
+    _background.start(data_path, catalog_path)
+    return catalog
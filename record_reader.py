@@ -0,0 +1,134 @@
+import re
+import mmap
+import threading
+
+import data_index
+import metrics
+from claim_row import claim_row_type
+
+_reader_lock = threading.Lock()
+_open_readers = {}
+
+
+class MappedDataFile:
+    """Read-only memory map over the pipe-delimited data file.
+
+    The mapping is shared (MAP_SHARED / ACCESS_READ), so every gunicorn worker
+    reads the same page-cache pages instead of holding its own copy. Lines are
+    only decoded once they are known to be candidates for the requested patient.
+    """
+
+    def __init__(self, data_path):
+        self.data_path = data_path
+        self.signature = data_index.data_file_signature(data_path)
+        self._file = open(data_path, 'rb')
+        self._map = None
+        self.headers = ['']
+        self.data_start = 0
+        if self.signature[0] > 0:
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+            self.headers, self.data_start = data_index.read_header(self._file)
+        self.pid_col = data_index.patient_column(self.headers)
+        self.row_type = claim_row_type(self.headers)
+
+    def close(self):
+        """Release the mapping and file handle"""
+        if self._map is not None:
+            self._map.close()
+        self._file.close()
+
+    def record_columns(self, offset, length):
+        """Decode and split the record stored at offset"""
+        return self._map[offset:offset + length].decode('utf-8').strip().split('|')
+
+    def read_records(self, locations):
+        """Build ClaimRows for (offset, length) pairs, e.g. from the patient index"""
+        rows = []
+        if self._map is None:
+            return rows
+        row_type = self.row_type
+        for offset, length in locations:
+            rows.append(row_type(self.record_columns(offset, length)))
+        metrics.inc('rows_scanned', len(rows))
+        return rows
+
+    def _line_bounds(self, pos):
+        """Find the start and end of the logical line containing pos"""
+        mm = self._map
+        start = max(mm.rfind(b'\n', 0, pos), mm.rfind(b'\r', 0, pos)) + 1
+        ends = [end for end in (mm.find(b'\n', pos), mm.find(b'\r', pos)) if end != -1]
+        return start, min(ends) if ends else len(mm)
+
+    def scan(self, patient_id):
+        """Find a patient's rows by searching the raw bytes for the patient_id value"""
+        rows = []
+        if self._map is None or self.pid_col is None:
+            return rows
+        wanted = patient_id.lower()
+        encoded = patient_id.encode('utf-8')
+        if not encoded.isascii():
+            # Byte-level case folding only covers ASCII; decode every line instead
+            return self._scan_decoded(wanted)
+
+        flags = re.IGNORECASE if encoded.lower() != encoded.upper() else 0
+        # The value must sit between column separators or line/whitespace boundaries
+        pattern = re.compile(rb'(?<![^|\s])' + re.escape(encoded) + rb'(?![^|\s])', flags)
+        pos = self.data_start
+        scanned = 0
+        while True:
+            match = pattern.search(self._map, pos)
+            if match is None:
+                break
+            start, end = self._line_bounds(match.start())
+            pos = end + 1
+            if start < self.data_start:
+                continue
+            scanned += 1
+            cols = data_index.parse_record(self._map[start:end], self.headers)
+            if cols is not None and cols[self.pid_col].lower() == wanted:
+                rows.append(self.row_type(cols))
+        metrics.inc('rows_scanned', scanned)
+        return rows
+
+    def scan_many(self, keys):
+        """Collect rows for a set of lowercased patient keys in one pass over the file"""
+        found = {key: [] for key in keys}
+        if self._map is None or self.pid_col is None:
+            return found
+        scanned = 0
+        with open(self.data_path, 'rb') as f:
+            for _, body in data_index.iter_records(f, self.data_start):
+                scanned += 1
+                cols = data_index.parse_record(body, self.headers)
+                if cols is not None:
+                    rows = found.get(cols[self.pid_col].lower())
+                    if rows is not None:
+                        rows.append(self.row_type(cols))
+        metrics.inc('rows_scanned', scanned)
+        return found
+
+    def _scan_decoded(self, wanted):
+        """Full decode-and-split scan, used when the byte search cannot be exact"""
+        rows = []
+        scanned = 0
+        with open(self.data_path, 'rb') as f:
+            for _, body in data_index.iter_records(f, self.data_start):
+                scanned += 1
+                cols = data_index.parse_record(body, self.headers)
+                if cols is not None and cols[self.pid_col].lower() == wanted:
+                    rows.append(self.row_type(cols))
+        metrics.inc('rows_scanned', scanned)
+        return rows
+
+
+def get_reader(data_path):
+    """Return the shared mapping for data_path, remapping it when the file changed"""
+    signature = data_index.data_file_signature(data_path)
+    with _reader_lock:
+        reader = _open_readers.get(data_path)
+        if reader is not None and reader.signature == signature:
+            return reader
+        # The previous mapping is not closed: threads may still be reading it,
+        # and it is released once the last of them drops its reference
+        reader = _open_readers[data_path] = MappedDataFile(data_path)
+        return reader
@@ -0,0 +1,43 @@
+"""Planned bills keep body text between the page margins"""
+from datetime import datetime
+
+import pytest
+
+import bill_layout
+
+pytest.importorskip('reportlab')
+
+GENERATED_AT = datetime(2024, 1, 2, 3, 4, 5)
+
+
+def claim_row(description):
+    return {
+        'patient_id': 'P00001',
+        'patient_name': 'Test Patient',
+        'date_of_service': '01/02/2024',
+        'code': '99214',
+        'code_desc': description,
+        'Charges': '12.50',
+    }
+
+
+def body_text(pages):
+    return [[op for op in ops if op[0] != 'line' and op[1] != 'footer'] for ops in pages]
+
+
+def test_description_longer_than_a_page_continues_on_the_next():
+    huge = 'OFFICE OUTPATIENT VISIT EST PATIENT MODERATE MEDICAL DECISION MAKING ' * 200
+    rows = [claim_row('SHORT VISIT'), claim_row(huge), claim_row('SHORT VISIT')]
+    pages = bill_layout.plan_bill(rows, 'Dr. Smith', 'Main Clinic', {'01/02/2024': ['I10']}, GENERATED_AT)
+    desc_lines = bill_layout.wrap_text(huge.strip(), 'small', bill_layout.DESC_WIDTH)
+    assert len(desc_lines) * bill_layout.DESC_LINE_HEIGHT > bill_layout.TOP - bill_layout.BOTTOM
+
+    assert len(pages) > 2
+    for page in body_text(pages):
+        assert all(y >= bill_layout.BOTTOM for _, _, _, y, _ in page)
+    for page in pages[1:-1]:
+        assert ('text', 'section', bill_layout.MARGIN_LEFT, bill_layout.TOP,
+                "SERVICES & CHARGES (CONTINUED)") in page
+        assert any(op[4] == "Description" for op in page)
+    drawn = [op[4] for page in pages for op in page if op[2] == bill_layout.COL_POSITIONS[3]]
+    assert [line for line in drawn if line in desc_lines] == list(desc_lines)
@@ -0,0 +1,26 @@
+"""Bill cache keys must not change between processes"""
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+KEY_SCRIPT = """
+from datetime import datetime
+import app
+rows = [{'patient_id': 'P00001', 'date_of_service': '01/02/2024', 'code': '99214',
+         'diagnosis_dxs': code, 'Charges': '10'} for code in ('E11.9', 'I10', 'Z00.00', 'M54.5', 'J45.909')]
+for _, _, key, args, _ in app.bill_jobs('P00001', rows, datetime(2024, 1, 2)):
+    print(key, args[3])
+"""
+
+
+def bill_keys(hash_seed):
+    env = dict(os.environ, PYTHONHASHSEED=str(hash_seed))
+    result = subprocess.run([sys.executable, '-c', KEY_SCRIPT], cwd=ROOT, env=env,
+                            capture_output=True, text=True, check=True)
+    return result.stdout
+
+
+def test_bill_cache_key_is_independent_of_hash_seed():
+    assert bill_keys(1) == bill_keys(2)
@@ -0,0 +1,57 @@
+"""Both PDF backends must draw the same text for the same planned bill"""
+import io
+import re
+from datetime import datetime
+
+import pytest
+
+import bill_layout
+import bill_render
+
+pypdf = pytest.importorskip('pypdf')
+pytest.importorskip('reportlab')
+
+GENERATED_AT = datetime(2024, 1, 2, 3, 4, 5)
+
+
+def claim_rows(count, description='OFFICE OUTPATIENT VISIT EST PATIENT'):
+    return [{
+        'patient_id': 'P00001',
+        'patient_name': 'Zoë O\'Brien (test) \\ name',
+        'date_of_service': '01/02/2024',
+        'code': f"992{i % 10:02d}",
+        'code_desc': description,
+        'Charges': f"{12.5 + i:.2f}",
+    } for i in range(count)]
+
+
+def page_texts(pdf_bytes):
+    """Extracted text per page, whitespace removed (the backends position words differently)"""
+    reader = pypdf.PdfReader(io.BytesIO(pdf_bytes))
+    return [re.sub(r'\s+', '', page.extract_text()) for page in reader.pages]
+
+
+def assert_same_text(pages):
+    reportlab_text = page_texts(bill_render.render_pages(pages, 'reportlab'))
+    direct_text = page_texts(bill_render.render_pages(pages, 'direct'))
+    assert len(reportlab_text) == len(direct_text) == len(pages)
+    assert reportlab_text == direct_text
+    return direct_text
+
+
+def test_one_page_bill():
+    pages = bill_layout.plan_bill(claim_rows(3), 'Dr. Smith', 'Main Clinic',
+                                  {'01/02/2024': ['E11.9', 'I10']}, GENERATED_AT)
+    assert len(pages) == 1
+    text = assert_same_text(pages)
+    assert 'Dr.Smith' in text[0]
+    assert 'E11.9' in text[0]
+
+
+def test_multi_page_bill():
+    rows = claim_rows(120, 'OFFICE OUTPATIENT VISIT EST PATIENT MODERATE MEDICAL DECISION MAKING ' * 2)
+    icds = {'01/02/2024': [f"A{i:02d}.{i % 10}" for i in range(400)]}
+    pages = bill_layout.plan_bill(rows, 'Dr. Smith', 'Main Clinic', icds, GENERATED_AT)
+    assert len(pages) > 2
+    text = assert_same_text(pages)
+    assert f"Page{len(pages)}of{len(pages)}" in text[-1]
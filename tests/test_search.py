@@ -0,0 +1,11 @@
+"""/search rejects filters it cannot search for with a 400"""
+import pytest
+
+import app
+
+
+@pytest.mark.parametrize('query', ['name=!!!', 'provider=-', 'name=%25', 'name=smith&provider=()'])
+def test_filters_without_words_are_rejected(query):
+    response = app.app.test_client().get(f"/search?{query}")
+    assert response.status_code == 400
+    assert 'no letters or digits' in response.get_json()['error']
@@ -0,0 +1,32 @@
+"""Cold start stays within its budget and keeps rendering-only modules out of startup"""
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+import benchmark
+
+# Seconds from process start to the first healthy /health, as `benchmark.py startup --budget`
+STARTUP_BUDGET_SECONDS = float(os.environ.get('STARTUP_BUDGET_SECONDS', 2.5))
+
+
+@pytest.fixture
+def artifact_paths(tmp_path, monkeypatch):
+    """Keep the index, store and catalog a started server builds out of the repository"""
+    for name in ('INDEX_PATH', 'STORE_PATH', 'CATALOG_PATH'):
+        monkeypatch.setenv(name, str(tmp_path / name.lower()))
+    monkeypatch.setenv('WARMUP', '0')
+
+
+def test_first_healthy_response_within_budget(artifact_paths):
+    seconds = benchmark.time_to_healthy(f"{sys.executable} app.py", benchmark.free_port(), timeout=60)
+    assert seconds <= STARTUP_BUDGET_SECONDS
+
+
+def test_importing_app_leaves_rendering_modules_unloaded(artifact_paths):
+    probe = subprocess.run([sys.executable, '-c', benchmark.IMPORT_PROBE, *benchmark.LAZY_MODULES],
+                           cwd=os.path.dirname(os.path.abspath(benchmark.__file__)),
+                           capture_output=True, text=True, check=True)
+    assert json.loads(probe.stdout.strip().splitlines()[-1]) == []
@@ -0,0 +1,92 @@
+import os
+import time
+import threading
+from datetime import datetime
+
+# Warm-up states
+PENDING = 'pending'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+
+def read_through(path, chunk_size=1024 * 1024):
+    """Read a file once so its pages are in the page cache before the first request"""
+    with open(path, 'rb') as f:
+        while f.read(chunk_size):
+            pass
+
+
+class Warmup:
+    """Runs named warm-up steps once per process in a background thread.
+
+    Each step is called with a progress(done, total) callback. Forked gunicorn
+    workers do not inherit the thread, so start() runs the steps again in any
+    process that has not warmed up yet. A failing step is recorded and the
+    remaining steps still run.
+    """
+
+    def __init__(self, steps):
+        self.steps = steps
+        self._lock = threading.Lock()
+        self._pid = None
+        self._state = None
+
+    def start(self):
+        """Start warming up this process unless it already has"""
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._state = {
+                'status': PENDING,
+                'step': None,
+                'steps': {name: {'status': PENDING, 'done': 0, 'total': 0} for name, _ in self.steps},
+                'started_at': datetime.now().isoformat(),
+                'finished_at': None,
+                'seconds': None,
+            }
+        threading.Thread(target=self._run, name='warmup', daemon=True).start()
+
+    def status(self):
+        """Get a copy of this process's warm-up progress"""
+        with self._lock:
+            if self._pid != os.getpid():
+                return None
+            state = dict(self._state)
+            state['steps'] = {name: dict(step) for name, step in state['steps'].items()}
+            return state
+
+    def is_done(self):
+        """Check whether every step in this process has finished, successfully or not"""
+        state = self.status()
+        return state is not None and state['status'] in (DONE, FAILED)
+
+    def _update(self, name=None, **fields):
+        with self._lock:
+            target = self._state['steps'][name] if name else self._state
+            target.update(fields)
+
+    def _run(self):
+        started = time.perf_counter()
+        self._update(status=RUNNING)
+        failed = False
+        for name, step in self.steps:
+            self._update(step=name)
+            self._update(name, status=RUNNING)
+
+            def progress(done, total, name=name):
+                self._update(name, done=done, total=total)
+
+            step_started = time.perf_counter()
+            try:
+                step(progress)
+                self._update(name, status=DONE)
+            except Exception as e:
+                print(f"Warning: Warm-up step {name} failed: {e}")
+                self._update(name, status=FAILED, error=str(e))
+                failed = True
+            self._update(name, seconds=round(time.perf_counter() - step_started, 3))
+        self._update(status=FAILED if failed else DONE, step=None,
+                     finished_at=datetime.now().isoformat(),
+                     seconds=round(time.perf_counter() - started, 3))